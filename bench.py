@@ -0,0 +1,146 @@
+"""
+Benchmarks of the codec, file I/O and memory use, written as JSON so that runs can be compared across commits:
+
+    python3 bench.py --output before.json
+    (change something)
+    python3 bench.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from pathlib import Path
+import ctpatch
+
+# How many times as long `import ctpatch; ctpatch.read_syx(...)` may take as importing the standard library modules
+# that ctpatch imports, both beyond a bare interpreter start. As a ratio, it holds on faster and slower machines.
+# Short-lived scripts pay this on every run, so main() fails if it's exceeded.
+# The baseline, before the compiled codec, measured 1.5. This allows for noise between runs.
+IMPORT_BUDGET_RATIO = 1.7
+STDLIB_IMPORTS = "import collections.abc, ctypes, dataclasses, enum, functools, operator, os, pathlib, struct, time"
+
+
+def per_call(func, number: int, repeat: int) -> float:
+    """Median seconds per call."""
+    return statistics.median(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def bench_codec(buffer: bytes, repeat: int) -> dict:
+    patch = ctpatch.decode(buffer)
+    return {
+        "decode_s": per_call(lambda: ctpatch.decode(buffer), 1000, repeat),
+        "encode_s": per_call(lambda: ctpatch.encode(patch), 1000, repeat),
+        "decode_reference_s": per_call(lambda: ctpatch.decode_reference(buffer), 200, repeat),
+        "encode_reference_s": per_call(lambda: ctpatch.encode_reference(patch), 200, repeat),
+        "check_bytes_s": per_call(lambda: ctpatch.check_bytes(buffer), 1000, repeat),
+    }
+
+
+def bench_files(buffer: bytes, file_count: int, repeat: int) -> dict:
+    patch = ctpatch.decode(buffer)
+    results = {"file_count": file_count}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [Path(directory) / f"{i:06}.syx" for i in range(file_count)]
+
+        def write_all():
+            for path in paths:
+                ctpatch.write_syx(path, patch)
+
+        def read_all():
+            for path in paths:
+                ctpatch.read_syx(path)
+
+        results["write_syx_files_per_s"] = file_count / min(timeit.repeat(write_all, number=1, repeat=repeat))
+        results["write_many_files_per_s"] = file_count / min(
+            timeit.repeat(lambda: ctpatch.write_many(paths, [patch] * file_count), number=1, repeat=repeat))
+        results["read_syx_files_per_s"] = file_count / min(timeit.repeat(read_all, number=1, repeat=repeat))
+    return results
+
+
+def bench_memory(buffer: bytes, count: int) -> dict:
+    tracemalloc.start()
+    patches = [ctpatch.decode(buffer) for _ in range(count)]
+    steady, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    ctpatch.decode(buffer)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "bytes_per_patch": steady / len(patches),
+        "peak_decode_bytes": peak - steady,
+    }
+
+
+def bench_import(repeat: int) -> dict:
+    codes = {
+        "interpreter": "pass",
+        "stdlib_import_s": STDLIB_IMPORTS,
+        "import_s": "import ctpatch",
+        "import_and_read_s": "import ctpatch; ctpatch.read_syx('example.syx')",
+    }
+    # Each repeat starts every process in turn, so that a busy spell on the machine slows them alike.
+    times = {name: [] for name in codes}
+    for _ in range(repeat):
+        for name, code in codes.items():
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], check=True, cwd=Path(__file__).parent)
+            times[name].append(time.perf_counter() - start)
+    interpreter = min(times.pop("interpreter"))
+    results = {name: min(values) - interpreter for name, values in times.items()}
+    results["import_and_read_ratio"] = results["import_and_read_s"] / results["stdlib_import_s"]
+    return results
+
+
+def compare(results: dict, previous: dict):
+    for section, values in results.items():
+        for name, value in values.items():
+            old = previous.get(section, {}).get(name)
+            if isinstance(value, float) and old:
+                print(f"{section}.{name}: {old:.4g} -> {value:.4g} ({value / old:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=2000, help="number of files in the generated corpus")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write the JSON results to this file, rather than stdout")
+    parser.add_argument("--compare", help="print ratios against an earlier JSON results file")
+    args = parser.parse_args()
+
+    buffer = (Path(__file__).parent / "example.syx").read_bytes()
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        commit = ""
+    results = {
+        "run": {"commit": commit, "python": platform.python_version(), "platform": platform.platform(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "codec": bench_codec(buffer, args.repeat),
+        "files": bench_files(buffer, args.files, args.repeat),
+        "memory": bench_memory(buffer, 1000),
+        # Process start-up times are noisy, so the fastest of more runs is taken.
+        "import": bench_import(max(args.repeat, 20)),
+    }
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        compare(results, json.loads(Path(args.compare).read_text()))
+    if results["import"]["import_and_read_ratio"] > IMPORT_BUDGET_RATIO:
+        sys.exit(f"Import and first read took {results['import']['import_and_read_ratio']:.2f} times as long as "
+                 f"importing the standard library modules ctpatch uses. The budget is {IMPORT_BUDGET_RATIO}.")
+
+
+if __name__ == "__main__":
+    main()
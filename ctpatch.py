@@ -2,15 +2,21 @@
 Read, modify and write .syx patch files for the Novation Circuit Tracks.
 """
 
-from ctypes import Structure, c_ubyte
-from dataclasses import dataclass, field, fields, is_dataclass
+from collections.abc import Callable, Sequence
+from ctypes import Structure, c_ubyte, sizeof as _sizeof
+from dataclasses import FrozenInstanceError, dataclass, field, fields, is_dataclass, replace
 from enum import IntEnum
+from functools import cache, cached_property, lru_cache
 from pathlib import Path
+import operator
+import os
 import struct
+import time
 
 
 @dataclass
 class BytesBuf:
+    """Bytes read in order by the decode functions of field metadata."""
     buffer: bytes
     read_offset: int = 0
 
@@ -25,7 +31,8 @@ def format(format: str) -> dict:
         return field_type(*buff.unpack(format))
     return dict(metadata=dict(
         decode=decode,
-        encode=lambda obj: struct.pack(format, obj)))
+        encode=lambda obj: struct.pack(format, obj),
+        format=format))
 
 
 def bitfield(format: str = "1s") -> dict:
@@ -33,7 +40,9 @@ def bitfield(format: str = "1s") -> dict:
         return field_type.from_buffer_copy(buff.unpack(format)[0])
     return dict(metadata=dict(
         decode=decode,
-        encode=bytearray))
+        encode=bytearray,
+        format=format,
+        bitfield=True))
 
 
 def list_len(length: int) -> dict:
@@ -44,7 +53,7 @@ def list_len(length: int) -> dict:
     def encode(obj_list):
         return b"".join(_encode(obj, {}) for obj in obj_list)
 
-    return dict(metadata=dict(decode=decode, encode=encode))
+    return dict(metadata=dict(decode=decode, encode=encode, list_len=length))
 
 
 def read_type(field_type) -> dict:
@@ -52,7 +61,8 @@ def read_type(field_type) -> dict:
         return _decode(field_type, {}, buff)
     return dict(metadata=dict(
         decode=decode,
-        encode=lambda obj: _encode(obj, {})))
+        encode=lambda obj: _encode(obj, {}),
+        read_type=field_type))
 
 
 PATCH_BYTES = 350
@@ -282,6 +292,7 @@ class FilterType(IntEnum):
 
 @dataclass
 class Header:
+    """The start of every sysex message: the manufacturer and product it's for."""
     sysex: int = 0xf0
     mfr_id: bytes = field(default=NOVATION_ID, **format("3s"))
     prod_type: int = 0x01
@@ -290,6 +301,7 @@ class Header:
 
 @dataclass
 class ReplaceCurrentPatchCommand:
+    """Replace the patch being played."""
     command_id: int = SysexCommand.REPLACE_CURRENT_PATCH
     location: int = 0
     _reserved: int = 0
@@ -297,6 +309,7 @@ class ReplaceCurrentPatchCommand:
 
 @dataclass
 class ReplacePatchCommand:
+    """Replace a patch stored in a pack."""
     command_id: int = SysexCommand.REPLACE_PATCH
     pack_index: int = field(default=0, **format("<H"))
     patch_index: int = 0
@@ -305,6 +318,7 @@ class ReplacePatchCommand:
 
 @dataclass
 class Meta:
+    """The patch name, category and genre."""
     _name: bytes = field(**format("16s"))
     category: int = 0
     genre: int = 0
@@ -323,6 +337,7 @@ class Meta:
 
 @dataclass
 class Voice:
+    """How notes are played: polyphony, portamento and octave."""
     polyphony_mode: PolyphonyMode
     portamento_rate: int
     pre_glide: int
@@ -331,6 +346,7 @@ class Voice:
 
 @dataclass
 class Osc:
+    """One of the two oscillators."""
     wave: OscWaveform
     wave_interpolate: int
     pulse_width_index: int
@@ -344,6 +360,7 @@ class Osc:
 
 @dataclass
 class Mixer:
+    """The levels of the oscillators, ring modulation, noise and FX."""
     osc1_level: int
     osc2_level: int
     ring_mod_level12: int
@@ -354,6 +371,7 @@ class Mixer:
 
 @dataclass
 class Filter:
+    """The filter, and the drive before it."""
     routing: int
     drive: int
     drive_type: DistortionType
@@ -367,6 +385,7 @@ class Filter:
 
 @dataclass
 class Envelope:
+    """One of the three envelopes: amp, filter and a free envelope."""
     velocity_or_delay: int
     attack: int
     decay: int
@@ -382,6 +401,8 @@ class LfoFlags(Structure):
         ("delay_trigger", c_ubyte, 1),
         ("fade_mode", c_ubyte, 4)
     ]
+    # The enum types of fields that have one, for field_index()
+    _enums_ = {"fade_mode": LfoFadeMode}
 
     def __repr__(self):
         return "LfoFlags(" + ", ".join(f"{k}={getattr(self, k)}" for k, t, b in self._fields_) + ")"
@@ -389,6 +410,7 @@ class LfoFlags(Structure):
 
 @dataclass
 class Lfo:
+    """One of the two LFOs."""
     waveform: LfoWaveform
     phase_offset: int
     slew_rate: int
@@ -401,6 +423,7 @@ class Lfo:
 
 @dataclass
 class Fx:
+    """The distortion, chorus and EQ settings."""
     distortion_level: int
     _fx_reserved1: int
     chorus_level: int
@@ -425,6 +448,7 @@ class Fx:
 
 @dataclass
 class ModMatrix:
+    """One of the 20 mod matrix slots: up to two sources modulating a destination."""
     source1: ModMatrixSource
     source2: ModMatrixSource
     depth: int
@@ -433,6 +457,7 @@ class ModMatrix:
 
 @dataclass
 class MacroKnobRange:
+    """One of the four ranges of a macro knob, each moving a destination."""
     destination: MacroKnobDestination
     start_pos: int
     end_pos: int
@@ -441,17 +466,20 @@ class MacroKnobRange:
 
 @dataclass
 class MacroKnob:
+    """One of the eight macro knobs."""
     position: int
     ranges: list[MacroKnobRange] = field(**list_len(4))
 
 
 @dataclass
 class Footer:
+    """The end of every sysex message."""
     eox: int = 0xf7
 
 
 @dataclass
 class PatchSysex:
+    """A patch, as the sysex message that sends it to or from the device."""
     header: Header
     command: ReplaceCurrentPatchCommand | ReplacePatchCommand = field(**read_type(ReplaceCurrentPatchCommand))
     meta: Meta
@@ -469,49 +497,1192 @@ class PatchSysex:
 
 @dataclass
 class CurrentPatchDumpRequestCommand:
+    """Ask the device to send its current patch."""
     command_id: int = SysexCommand.REQUEST_DUMP_CURRENT_PATCH
     location: int = 0
 
 
 @dataclass
 class PatchDumpRequest:
+    """A sysex message asking the device to send a patch."""
     header: Header = field(default_factory=Header)
     command: CurrentPatchDumpRequestCommand = field(default_factory=CurrentPatchDumpRequestCommand)
     footer: Footer = field(default_factory=Footer)
 
 
+class Stats:
+    """
+    Counts and total seconds of instrumented operations, by name: "decode", "decode.<section>", "encode",
+    "validate", "read_syx", "write_syx", "write_many", "write_bank", and "file_read"/"file_write" for the file I/O
+    of read_syx() and write_syx() alone.
+    Times of outer operations include those of the operations they call, e.g. read_syx includes decode.
+
+    Instrumentation is off unless a Stats is enabled, with enable_stats() or as a context manager:
+
+        with ctpatch.Stats() as stats:
+            ctpatch.read_syx("example.syx")
+        print(stats.snapshot())
+    """
+
+    def __init__(self):
+        self.counts: dict[str, int] = {}
+        self.seconds: dict[str, float] = {}
+        # Called with (name, seconds) for every timed operation
+        self.callbacks: list[Callable[[str, float], None]] = []
+        self._previous = []
+
+    def add(self, name: str, seconds: float):
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        for callback in self.callbacks:
+            callback(name, seconds)
+
+    def snapshot(self) -> dict[str, dict]:
+        """A JSON-serializable copy of the counts, total and mean seconds, by name."""
+        return {name: {"count": count, "seconds": self.seconds[name], "mean_s": self.seconds[name] / count}
+                for name, count in self.counts.items()}
+
+    def reset(self):
+        self.counts.clear()
+        self.seconds.clear()
+
+    def __enter__(self):
+        global _stats
+        self._previous.append(_stats)
+        _stats = self
+        return self
+
+    def __exit__(self, *exc_info):
+        global _stats
+        _stats = self._previous.pop()
+
+
+# The enabled Stats. None when instrumentation is off, so hot paths only pay for a global lookup.
+_stats: Stats | None = None
+
+
+def enable_stats(stats: Stats | None = None) -> Stats:
+    """Start recording into stats, or into a new Stats if not given, and return it."""
+    global _stats
+    _stats = Stats() if stats is None else stats
+    return _stats
+
+
+def disable_stats() -> Stats | None:
+    """Stop recording. Returns the Stats that was recording, if any."""
+    global _stats
+    stats, _stats = _stats, None
+    return stats
+
+
+def get_stats() -> Stats | None:
+    return _stats
+
+
 def read_syx(syx_filename: str | Path) -> PatchSysex:
+    if _stats is not None:
+        return _timed(_stats, "read_syx", _read_syx, syx_filename)
+    return _read_syx(syx_filename)
+
+
+def _read_syx(syx_filename: str | Path) -> PatchSysex:
+    start = time.perf_counter()
     with open(syx_filename, "rb") as f:
         buffer = f.read()
-    assert len(buffer) == PATCH_BYTES
-    patch = decode(buffer)
-    validate(patch)
-    return patch
+    if _stats is not None:
+        _stats.add("file_read", time.perf_counter() - start)
+    codec = codec_for(buffer)
+    if len(buffer) != codec.size:
+        raise ValueError(f"'{syx_filename}' is {len(buffer)} bytes. Expected {codec.size}.")
+    # Checking the bytes first rejects bad files before decoding them.
+    violations = _check_bytes(buffer, codec)
+    if violations:
+        raise ValidationError(violations)
+    return codec.decode(buffer)
 
 
 def write_syx(syx_filename: str | Path, patch: PatchSysex):
-    validate(patch)
-    bytes = encode(patch)
-    assert len(bytes) == PATCH_BYTES
+    if _stats is not None:
+        return _timed(_stats, "write_syx", _write_syx, syx_filename, patch)
+    _write_syx(syx_filename, patch)
+
+
+def _write_syx(syx_filename: str | Path, patch: PatchSysex):
+    if _stats is not None:
+        bytes, violations = _timed(_stats, "validate", _encode_checked, patch)
+    else:
+        bytes, violations = _encode_checked(patch)
+    if violations:
+        raise ValidationError(violations)
+    size = patch._codec.size if isinstance(patch, _View) else get_codec(type(patch.command)).size
+    if len(bytes) != size:
+        raise ValueError(f"Patch is {len(bytes)} bytes. Expected {size}.")
+    start = time.perf_counter()
     with open(syx_filename, "wb") as f:
         f.write(bytes)
+    if _stats is not None:
+        _stats.add("file_write", time.perf_counter() - start)
+
+
+class _Record:
+    # Results are plain classes with the repr and equality of a dataclass, by the fields in their __slots__,
+    # since each dataclass takes most of a millisecond to create on import.
+    __slots__ = ()
+
+    def _values(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={value!r}" for name, value in zip(self.__slots__, self._values()))
+        return f"{type(self).__name__}({fields})"
 
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._values() == other._values()
 
-def validate(patch: PatchSysex):
-    assert patch.header.mfr_id == NOVATION_ID
-    assert patch.header.prod_num in (CIRCUIT_TRACKS_ID, CIRCUIT_ORIGINAL_ID)
-    assert len(patch.oscillators) == 2
-    assert len(patch.envelopes) == 3
-    assert len(patch.mod_matrix) == 20
-    assert len(patch.macro_knobs) == 8
-    assert patch.footer.eox == 0xf7
+    __hash__ = None
+
+    def __reduce__(self):
+        return type(self), self._values()
+
+
+class _FrozenRecord(_Record):
+    # A _Record like a frozen dataclass: hashable, and its fields can't be assigned.
+    __slots__ = ()
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __setattr__(self, name, value):
+        raise FrozenInstanceError(f"cannot assign to field '{name}'")
+
+    def __delattr__(self, name):
+        raise FrozenInstanceError(f"cannot delete field '{name}'")
+
+
+class WriteResult(_Record):
+    """How much write_many() or write_bank() wrote, and how long it took."""
+    __slots__ = ("files", "bytes", "seconds")
+
+    def __init__(self, files: int, bytes: int, seconds: float):
+        self.files = files
+        self.bytes = bytes
+        self.seconds = seconds
+
+    @property
+    def files_per_second(self) -> float:
+        return self.files / self.seconds if self.seconds else 0.0
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+
+# fsync policies of write_many() and write_bank()
+FSYNC_POLICIES = ("none", "file", "dir")
+
+
+def write_many(syx_filenames, patches, workers: int | None = None, fsync: str = "none",
+               chunksize: int = 256) -> WriteResult:
+    """
+    Write many patches to their own .syx files. The patches are validated and encoded into one buffer first,
+    so nothing is written if any is invalid, and the files are then written across a pool of threads.
+    patches may be PatchSysex instances or encoded patches, or a PatchTable or (N, size) array, whose rows are
+    checked in one vectorized pass.
+    Each file is written beside its path and then renamed over it, so a reader never sees half a patch.
+    fsync is "none", "file" to flush each file to disk before renaming it, or "dir" to also flush
+    each directory afterwards, so that the new files survive a crash. workers=1 writes in this thread.
+    """
+    if _stats is not None:
+        return _timed(_stats, "write_many", _write_many, syx_filenames, patches, workers, fsync, chunksize)
+    return _write_many(syx_filenames, patches, workers, fsync, chunksize)
+
+
+def _write_many(syx_filenames, patches, workers: int | None, fsync: str, chunksize: int) -> WriteResult:
+    _check_fsync(fsync)
+    start = time.perf_counter()
+    buffer, offsets = _encode_many(patches)
+    paths = [str(f) for f in syx_filenames]
+    if len(paths) != len(offsets) - 1:
+        raise ValueError(f"Expected a file name for each of {len(offsets) - 1} patches. (Given {len(paths)})")
+    items = [(path, buffer[offsets[i]:offsets[i + 1]]) for i, path in enumerate(paths)]
+    chunks = [items[i:i + chunksize] for i in range(0, len(items), chunksize)]
+    if workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            _replace_files(chunk, fsync != "none")
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        from functools import partial
+        with ThreadPoolExecutor(workers) as executor:
+            list(executor.map(partial(_replace_files, sync=fsync != "none"), chunks))
+    if fsync == "dir":
+        _fsync_dirs({os.path.dirname(os.path.abspath(path)) for path in paths})
+    return WriteResult(len(paths), len(buffer), time.perf_counter() - start)
+
+
+def write_bank(syx_filename: str | Path, patches, fsync: str = "none") -> WriteResult:
+    """
+    Write many patches to one .syx file, as concatenated messages that SyxBank reads.
+    Validation, encoding, atomic replacement and fsync are as for write_many().
+    """
+    if _stats is not None:
+        return _timed(_stats, "write_bank", _write_bank, syx_filename, patches, fsync)
+    return _write_bank(syx_filename, patches, fsync)
+
+
+def _write_bank(syx_filename: str | Path, patches, fsync: str) -> WriteResult:
+    _check_fsync(fsync)
+    start = time.perf_counter()
+    buffer, _ = _encode_many(patches)
+    _replace_files([(str(syx_filename), buffer)], fsync != "none")
+    if fsync == "dir":
+        _fsync_dirs({os.path.dirname(os.path.abspath(syx_filename))})
+    return WriteResult(1, len(buffer), time.perf_counter() - start)
+
+
+def _encode_many(patches) -> tuple[memoryview, list[int]]:
+    """Validate and encode patches into one buffer. Returns the buffer, and the offsets of the patches and its end."""
+    if getattr(patches, "ndim", None) == 2 and len(patches):
+        # An (N, size) array, taken to be patches of its first row's layout
+        patches = PatchTable(patches, _command_type(bytes(patches[0, :7])))
+    if isinstance(patches, PatchTable):
+        return _checked_table(patches)
+    # Views and clones are already encoded.
+    patches = [bytes(patch) if isinstance(patch, _View) else patch for patch in patches]
+    encoders = [get_codec(type(patch.command)) if isinstance(patch, PatchSysex) else None for patch in patches]
+    sizes = [len(patch) if encoder is None else encoder.size for patch, encoder in zip(patches, encoders)]
+    offsets = [0]
+    for size in sizes:
+        offsets.append(offsets[-1] + size)
+    buffer = bytearray(offsets[-1])
+    for i, (patch, encoder) in enumerate(zip(patches, encoders)):
+        if encoder is None:
+            buffer[offsets[i]:offsets[i + 1]] = patch
+        else:
+            try:
+                encoder.encode_into(buffer, offsets[i], patch)
+            except (struct.error, TypeError):
+                # Let check() say what's wrong.
+                validate(patch)
+                raise
+    buffer = memoryview(buffer)
+    return _checked_many(buffer, offsets, [_command_type(buffer[offset:]) for offset in offsets[:-1]])
+
+
+def _checked_table(table: "PatchTable"):
+    # Checks the rows in one vectorized pass, and only those it flags with check_bytes(), for the errors.
+    import numpy as np
+    codec = table.codec
+    for row in np.flatnonzero(_suspect_rows(table.data, _validation_rules(codec, False))):
+        violations = _check_bytes(table.data[row].tobytes(), codec)
+        if violations:
+            raise ValueError(f"Patch {row} is invalid: {ValidationError(violations)}")
+    return memoryview(table.data).cast("B"), list(range(0, codec.size * (len(table) + 1), codec.size))
+
+
+def _checked_many(buffer: memoryview, offsets: list[int], command_types: list[type]):
+    for i, command_type in enumerate(command_types):
+        violations = check_bytes(buffer[offsets[i]:offsets[i + 1]], command_type)
+        if violations:
+            raise ValueError(f"Patch {i} is invalid: {ValidationError(violations)}")
+    return buffer, offsets
+
+
+def _check_fsync(fsync: str):
+    if fsync not in FSYNC_POLICIES:
+        raise ValueError(f"fsync should be one of {FSYNC_POLICIES}. (Given {fsync!r})")
+
+
+def _replace_files(items: list[tuple[str, bytes]], sync: bool):
+    for path, data in items:
+        _replace_file(path, data, sync)
+
+
+def _replace_file(path: str, data, sync: bool = False):
+    # Write beside the file and then replace it, so that an interrupted write can't leave half a patch.
+    # The temporary file has a unique name, so that threads and processes writing the same path don't collide,
+    # and is created with the mode open() gives, less the umask at the time.
+    # os.write() skips building a buffered file object for each file.
+    # A symlink's target is replaced, rather than the link, and keeps its permissions.
+    path = os.path.realpath(path)
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = None
+    directory, name = os.path.split(path)
+    while True:
+        temp = os.path.join(directory, f".{name}.{os.urandom(4).hex()}.tmp")
+        try:
+            fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        try:
+            if mode is not None:
+                os.chmod(temp, mode)
+            data = memoryview(data)
+            while data:
+                data = data[os.write(fd, data):]
+            if sync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+def _fsync_dirs(directories):
+    # Windows can't open directories, and doesn't need them flushing for renames to last.
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    for directory in directories:
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _timed(stats: Stats, name: str, func, *args):
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        stats.add(name, time.perf_counter() - start)
+
+
+class ReadResult(_Record):
+    """The outcome of reading one .syx file: the patch, or the error that stopped it being read."""
+    __slots__ = ("path", "patch", "error")
+
+    def __init__(self, path: Path, patch: PatchSysex | None = None, error: Exception | None = None):
+        self.path = path
+        self.patch = patch
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def iter_syx(syx_filenames, workers: int | None = None, ordered: bool = True, chunksize: int = 64):
+    """
+    Read many .syx files across a process pool, yielding a ReadResult per file.
+    A file that fails to read gives a result with its error, rather than stopping the batch.
+    Results are yielded in the order given, or as they complete if not ordered.
+    workers=1 reads in this process.
+    """
+    paths = [Path(f) for f in syx_filenames]
+    chunks = [paths[i:i + chunksize] for i in range(0, len(paths), chunksize)]
+    if workers == 1:
+        for chunk in chunks:
+            yield from _read_results(chunk)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(workers) as executor:
+        if ordered:
+            for results in executor.map(_read_results, chunks):
+                yield from results
+        else:
+            for future in as_completed([executor.submit(_read_results, chunk) for chunk in chunks]):
+                yield from future.result()
+
+
+def read_dir(path: str | Path, workers: int | None = None, pattern: str = "*.syx", ordered: bool = True):
+    """iter_syx() over the .syx files of a directory, in sorted order. Use pattern="**/*.syx" to include subdirectories."""
+    return iter_syx(sorted(Path(path).glob(pattern)), workers, ordered)
+
+
+def _read_results(paths: list[Path]) -> list[ReadResult]:
+    results = []
+    for path in paths:
+        try:
+            results.append(ReadResult(path, read_syx(path)))
+        except Exception as e:
+            results.append(ReadResult(path, error=e))
+    return results
+
+
+class SyxCache:
+    """
+    A sqlite database of validated patch bytes in front of read_syx(), keyed by file path, size and mtime_ns,
+    so that rereading an unchanged file only stats it. Misses are committed by commit() or on close.
+
+        with SyxCache("library.db") as cache:
+            patches = [cache.read_syx(f) for f in files]
+            print(cache.hits, cache.misses)
+    """
+
+    def __init__(self, db_filename: str | Path):
+        import sqlite3
+        self._db = sqlite3.connect(db_filename)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS patches ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, payload BLOB, name BLOB, category INTEGER, genre INTEGER)")
+        self.hits = 0
+        self.misses = 0
+
+    def read_syx(self, syx_filename: str | Path) -> PatchSysex:
+        path, stat, row = self._lookup(syx_filename, "payload")
+        if row is not None:
+            return decode(row[0])
+        patch = read_syx(path)
+        self._store(path, stat, patch)
+        return patch
+
+    def read_meta(self, syx_filename: str | Path) -> Meta:
+        """The patch's Meta, from the cached columns if the file is unchanged."""
+        path, stat, row = self._lookup(syx_filename, "name, category, genre")
+        if row is not None:
+            return Meta(*row)
+        patch = read_syx(path)
+        self._store(path, stat, patch)
+        return patch.meta
+
+    def iter_syx(self, syx_filenames, workers: int | None = None):
+        """Like iter_syx(), but only files that aren't cached are read. Cached results come first."""
+        misses = {}
+        for syx_filename in syx_filenames:
+            path, stat, row = self._lookup(syx_filename, "payload")
+            if row is None:
+                misses[path] = syx_filename, stat
+            else:
+                yield ReadResult(Path(syx_filename), decode(row[0]))
+        for result in iter_syx(misses, workers):
+            syx_filename, stat = misses[str(result.path)]
+            if result.ok:
+                self._store(str(result.path), stat, result.patch)
+            yield ReadResult(Path(syx_filename), result.patch, result.error)
+
+    def evict_missing(self) -> int:
+        """Remove the entries of files that no longer exist. Returns the number removed."""
+        missing = [(path,) for path, in self._db.execute("SELECT path FROM patches") if not os.path.exists(path)]
+        self._db.executemany("DELETE FROM patches WHERE path = ?", missing)
+        self._db.commit()
+        return len(missing)
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _lookup(self, syx_filename: str | Path, columns: str):
+        path = os.path.abspath(syx_filename)
+        stat = os.stat(path)
+        row = self._db.execute(
+            f"SELECT {columns} FROM patches WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return path, stat, row
+
+    def _store(self, path: str, stat: os.stat_result, patch: PatchSysex):
+        self._db.execute(
+            "INSERT OR REPLACE INTO patches VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime_ns, encode(patch), patch.meta.name, patch.meta.category, patch.meta.genre))
+
+
+class DuplicateIndex:
+    """
+    A sqlite database of the sound_hash() of many .syx files, for finding
+    duplicate sounds across libraries. Files are hashed from their raw bytes.
+
+        with DuplicateIndex("sounds.db") as index:
+            index.add_files(Path("library").glob("**/*.syx"))
+            for paths in index.duplicates():
+                print(paths)
+    """
+
+    def __init__(self, db_filename: str | Path):
+        import sqlite3
+        self._db = sqlite3.connect(db_filename)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sounds (path TEXT PRIMARY KEY, hash BLOB)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS sounds_hash ON sounds (hash)")
+
+    def add_files(self, syx_filenames, batch_size: int = 10000) -> list[Path]:
+        """
+        Hash and add files, in one pass, each with the command of its registered layout.
+        Returns the files that weren't patches of a registered layout and its size, and weren't added.
+        """
+        skipped = []
+        batch = []
+        for syx_filename in syx_filenames:
+            buffer = Path(syx_filename).read_bytes()
+            layout = _layouts.get((buffer[5], buffer[6])) if len(buffer) > 6 else None
+            # sound_hash() finds the sound sections in the PatchSysex layout.
+            if layout is None or layout[0] is not PatchSysex or len(buffer) != codec_for(buffer).size:
+                skipped.append(Path(syx_filename))
+                continue
+            batch.append((os.path.abspath(syx_filename), sound_hash(buffer, layout[1])))
+            if len(batch) == batch_size:
+                self._add(batch)
+                batch = []
+        self._add(batch)
+        return skipped
+
+    def add(self, key: str, buffer, command_type=ReplaceCurrentPatchCommand):
+        """Add an encoded patch under any key, e.g. a bank file and message index."""
+        self._add([(key, sound_hash(buffer, command_type))])
+
+    def duplicates(self, min_count: int = 2):
+        """Yield lists of the keys that share a sound, for sounds with at least min_count keys."""
+        rows = self._db.execute(
+            "SELECT hash, path FROM sounds WHERE hash IN "
+            "(SELECT hash FROM sounds GROUP BY hash HAVING COUNT(*) >= ?) ORDER BY hash, path", (min_count,))
+        group, group_hash = [], None
+        for hash, path in rows:
+            if hash != group_hash and group:
+                yield group
+                group = []
+            group_hash = hash
+            group.append(path)
+        if group:
+            yield group
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _add(self, rows):
+        self._db.executemany("INSERT OR REPLACE INTO sounds VALUES (?, ?)", rows)
+        self._db.commit()
+
+
+class SyxBank(Sequence):
+    """
+    The sysex messages in a .syx file, such as a librarian's dump of many patches.
+    The file is memory-mapped and only indexed by message boundaries (F0...F7) when opened;
+    a patch is decoded only when its index is accessed. Messages are decoded as command_type,
+    or if that's None, with the codec of each message's layout, so that files can mix devices and commands.
+    """
+
+    def __init__(self, syx_filename: str | Path, command_type=None):
+        import mmap
+        self.command_type = command_type
+        self.codec = None if command_type is None else get_codec(command_type)
+        with open(syx_filename, "rb") as f:
+            # mmap can't map an empty file.
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if f.seek(0, 2) else b""
+        self.starts, self.ends = _message_offsets(self._buffer)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        message = self.raw(index)
+        codec = self.codec or codec_for(message)
+        if len(message) != codec.size:
+            raise ValueError(f"Message {index} is {len(message)} bytes. Expected {codec.size}.")
+        return codec.decode(message)
+
+    def raw(self, index: int) -> bytes:
+        return self._buffer[self.starts[index]:self.ends[index]]
+
+    def view(self, index: int) -> "PatchView":
+        """A read-only PatchView of a message, directly over the mapped file."""
+        return PatchView(self._buffer, self.starts[index], self.command_type)
+
+    def close(self):
+        if not isinstance(self._buffer, bytes):
+            self._buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _message_offsets(buffer) -> tuple[Sequence[int], Sequence[int]]:
+    from array import array
+    starts, ends = array("q"), array("q")
+    start = buffer.find(b"\xf0")
+    while start != -1:
+        end = buffer.find(b"\xf7", start)
+        if end == -1:
+            # Ignore a truncated final message
+            break
+        starts.append(start)
+        ends.append(end + 1)
+        start = buffer.find(b"\xf0", end)
+    return starts, ends
+
+
+# Bytes per second of a MIDI DIN connection: 31250 baud, at 10 bits per byte.
+MIDI_BYTES_PER_SECOND = 3125
+
+
+class RtMidiTransport:
+    """Sends messages through a python-rtmidi MidiOut, and receives sysex through an optional MidiIn. See example.py."""
+
+    def __init__(self, midiout, midiin=None):
+        self.midiout = midiout
+        self.midiin = midiin
+        self._received = None
+
+    async def send(self, message: bytes):
+        self.midiout.send_message(message)
+
+    async def receive(self) -> bytes:
+        if self._received is None:
+            import asyncio
+            loop = asyncio.get_running_loop()
+            self._received = asyncio.Queue()
+            # rtmidi calls back on its own thread.
+            self.midiin.ignore_types(sysex=False)
+            self.midiin.set_callback(
+                lambda event, _: loop.call_soon_threadsafe(self._received.put_nowait, bytes(event[0])))
+        return await self._received.get()
+
+
+class LoopbackTransport:
+    """An in-process stand-in for a MIDI output, which records each message with the time it was sent."""
+
+    def __init__(self):
+        self.sent: list[tuple[float, bytes]] = []
+
+    async def send(self, message: bytes):
+        self.sent.append((time.perf_counter(), bytes(message)))
+
+    def bytes_per_second(self) -> float:
+        """The throughput from the first message sent to the last."""
+        if len(self.sent) < 2:
+            return 0.0
+        duration = self.sent[-1][0] - self.sent[0][0]
+        return sum(len(message) for _, message in self.sent[:-1]) / duration
+
+
+class FakeDevice:
+    """
+    An in-process stand-in for a device connection, which answers each PatchDumpRequest
+    for location N with the Nth .syx file of a directory, in sorted order, after latency seconds.
+    Every drop_every'th request is ignored, to exercise retries.
+    """
+
+    def __init__(self, directory: str | Path, latency: float = 0.0, drop_every: int = 0):
+        self.patches = [path.read_bytes() for path in sorted(Path(directory).glob("*.syx"))]
+        self.latency = latency
+        self.drop_every = drop_every
+        self.requests = 0
+        self._replies = None
+
+    async def send(self, message: bytes):
+        import asyncio
+        if self._replies is None:
+            self._replies = asyncio.Queue()
+        self.requests += 1
+        location = message[7]
+        if (message[6] != SysexCommand.REQUEST_DUMP_CURRENT_PATCH or location >= len(self.patches)
+                or self.drop_every and self.requests % self.drop_every == 0):
+            return
+        reply = bytearray(self.patches[location])
+        set_field(reply, "command.location", location)
+        asyncio.get_running_loop().call_later(self.latency, self._replies.put_nowait, bytes(reply))
+
+    async def receive(self) -> bytes:
+        import asyncio
+        if self._replies is None:
+            self._replies = asyncio.Queue()
+        return await self._replies.get()
+
+
+class DumpResult(_Record):
+    """The outcome of a dump request: the patch, or the error that stopped it being received."""
+    __slots__ = ("location", "patch", "error")
+
+    def __init__(self, location: int, patch: PatchSysex | None = None, error: Exception | None = None):
+        self.location = location
+        self.patch = patch
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+async def backup(locations, transport, out_dir: str | Path | None = None, concurrency: int = 4,
+                 timeout: float = 1.0, retries: int = 2):
+    """
+    Request patch dumps of many locations, and yield a DumpResult for each as it arrives.
+    Up to concurrency requests are outstanding at once, and a request that isn't answered
+    within timeout seconds is sent again up to retries times. Replies are matched to requests
+    by their command location, and written to out_dir (if given) as they arrive, as NNN.syx.
+    transport is anything with async send(message) and receive() methods, e.g. RtMidiTransport or FakeDevice.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    pending: dict[int, asyncio.Future] = {}
+    results = asyncio.Queue()
+    semaphore = asyncio.Semaphore(concurrency)
+    if out_dir is not None:
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+
+    async def receive_replies():
+        while True:
+            message = await transport.receive()
+            try:
+                patch = decode(message)
+            except Exception:
+                # Not a patch, or not one we can read
+                continue
+            future = pending.get(patch.command.location)
+            if future is not None and not future.done():
+                future.set_result(patch)
+
+    async def request(location: int):
+        async with semaphore:
+            try:
+                patch = await request_patch(location)
+                if out_dir is not None:
+                    write_syx(Path(out_dir) / f"{location:03}.syx", patch)
+                result = DumpResult(location, patch)
+            except Exception as e:
+                result = DumpResult(location, error=e)
+            finally:
+                pending.pop(location, None)
+            await results.put(result)
+
+    async def request_patch(location: int) -> PatchSysex:
+        message = encode(PatchDumpRequest(command=CurrentPatchDumpRequestCommand(location=location)))
+        for _ in range(retries + 1):
+            pending[location] = loop.create_future()
+            await transport.send(message)
+            try:
+                return await asyncio.wait_for(pending[location], timeout)
+            except asyncio.TimeoutError:
+                pass
+        raise TimeoutError(f"No reply for location {location} after {retries + 1} requests.")
+
+    locations = list(dict.fromkeys(locations))
+    receiver = asyncio.create_task(receive_replies())
+    requests = [asyncio.create_task(request(location)) for location in locations]
+    try:
+        for _ in locations:
+            yield await results.get()
+    finally:
+        receiver.cancel()
+        for task in requests:
+            task.cancel()
+
+
+async def upload(items, transport, bytes_per_second: float | None = MIDI_BYTES_PER_SECOND, interval: float = 0.0,
+                 prefetch: int = 16) -> int:
+    """
+    Send patches to pack slots. items are (pack_index, patch_index, patch), where patch is a PatchSysex or
+    a PatchView such as a clone(), and each patch is sent as a copy with its command replaced by a
+    ReplacePatchCommand for the slot.
+    transport is anything with an async send(message) method, e.g. RtMidiTransport or LoopbackTransport.
+    Sending is paced so that each message starts when the previous one has had time to transmit at
+    bytes_per_second, and at least interval seconds after it. Patches are encoded up to prefetch
+    messages ahead, while waiting to send. Returns the number of messages sent.
+    """
+    import asyncio
+    queue = asyncio.Queue(maxsize=prefetch)
+
+    async def encode_items():
+        try:
+            for pack_index, patch_index, patch in items:
+                command = ReplacePatchCommand(pack_index=pack_index, patch_index=patch_index)
+                await queue.put(encode(_with_command(patch, command)))
+        except Exception:
+            # Stop the sender, which then raises this from the awaited encoder
+            await queue.put(None)
+            raise
+        await queue.put(None)
+
+    encoder = asyncio.create_task(encode_items())
+    loop = asyncio.get_running_loop()
+    sent = 0
+    next_time = loop.time()
+    try:
+        while (message := await queue.get()) is not None:
+            delay = next_time - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            start = loop.time()
+            await transport.send(message)
+            sent += 1
+            next_time = start + max(interval, len(message) / bytes_per_second if bytes_per_second else 0.0)
+        await encoder
+    finally:
+        encoder.cancel()
+    return sent
+
+
+class PatchPack:
+    """
+    The numbered patch slots of a pack. A pack reads and writes as a directory of NN.syx files,
+    or as a single .syx of ReplacePatchCommand messages, in one go. Syncing to a mirror directory
+    or a device only writes or sends the slots whose contents changed since the last sync.
+
+        pack = PatchPack.read("pack1.syx")
+        pack.slots[8].filter.type = FilterType.HIGH_PASS_24DB
+        asyncio.run(pack.upload(RtMidiTransport(midiout)))  # Sends slot 8 only
+    """
+
+    def __init__(self, pack_index: int = 0, slots: dict[int, PatchSysex] | None = None):
+        self.pack_index = pack_index
+        self.slots = dict(slots or {})
+        # Slot content hashes, as at the last upload
+        self.uploaded: dict[int, bytes] = {}
+
+    @classmethod
+    def read(cls, path: str | Path, pack_index: int = 0) -> "PatchPack":
+        """Read a directory of NN.syx files, or a .syx file of ReplacePatchCommand messages."""
+        path = Path(path)
+        if path.is_dir():
+            return cls(pack_index, {int(f.stem): read_syx(f) for f in sorted(path.glob("*.syx")) if f.stem.isdigit()})
+        with SyxBank(path, ReplacePatchCommand) as bank:
+            patches = list(bank)
+        pack_index = patches[0].command.pack_index if patches else pack_index
+        return cls(pack_index, {patch.command.patch_index: patch for patch in patches})
+
+    def write(self, path: str | Path):
+        """
+        Write to a directory of NN.syx files or, if path ends with .syx, a single file.
+        The single file is validated and replaced atomically, as by write_bank().
+        """
+        path = Path(path)
+        if path.suffix == ".syx":
+            write_bank(path, [_with_command(patch, self._command(slot)) for slot, patch in sorted(self.slots.items())])
+        else:
+            self.sync_dir(path, only_changed=False)
+
+    def sync_dir(self, directory: str | Path, only_changed: bool = True) -> list[int]:
+        """Write the slots whose NN.syx file in directory is missing or different. Returns the slots written."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        written = []
+        for slot, patch in sorted(self.slots.items()):
+            path = directory / f"{slot:02}.syx"
+            if only_changed and path.exists() and _slot_hash(path.read_bytes()) == self.slot_hash(slot):
+                continue
+            write_syx(path, _with_command(patch, ReplaceCurrentPatchCommand()))
+            written.append(slot)
+        return written
+
+    def changed(self) -> list[int]:
+        """The slots whose contents changed since the last upload."""
+        return [slot for slot in sorted(self.slots) if self.uploaded.get(slot) != self.slot_hash(slot)]
+
+    async def upload(self, transport, only_changed: bool = True, **kwargs) -> list[int]:
+        """Upload the changed slots with upload(). Returns the slots sent."""
+        slots = self.changed() if only_changed else sorted(self.slots)
+        hashes = {slot: self.slot_hash(slot) for slot in slots}
+        await upload(((self.pack_index, slot, self.slots[slot]) for slot in slots), transport, **kwargs)
+        self.uploaded.update(hashes)
+        return slots
+
+    def slot_hash(self, slot: int) -> bytes:
+        """A hash of the slot's encoded patch, ignoring the sysex command."""
+        return _slot_hash(encode(self.slots[slot]))
+
+    def _command(self, slot: int) -> ReplacePatchCommand:
+        return ReplacePatchCommand(pack_index=self.pack_index, patch_index=slot)
+
+
+def _with_command(patch, command):
+    """A copy of a PatchSysex, PatchView or encoded patch with its command replaced, as a PatchSysex or PatchClone."""
+    if isinstance(patch, PatchSysex):
+        return replace(patch, command=command)
+    # The command's size may differ, so the new command's bytes replace the old ones rather than being set in place.
+    buffer = bytes(patch)
+    start, end = get_codec(_command_type(buffer)).span("command")
+    return PatchClone(buffer[:start] + encode(command) + buffer[end:], type(command))
+
+
+def _slot_hash(buffer: bytes) -> bytes:
+    import hashlib
+    # The command is the same size for any patch in the file, but differs between command types.
+    start, end = get_codec(_command_type(buffer)).span("command")
+    return hashlib.blake2b(buffer[:start] + buffer[end:], digest_size=16).digest()
+
+
+def _command_type(buffer) -> type:
+    """The command type of an encoded patch, from its registered layout or else its sysex command byte."""
+    patch_type, command_type = _layouts.get((buffer[5], buffer[6]), (None, None))
+    if patch_type is PatchSysex:
+        return command_type
+    return ReplacePatchCommand if buffer[6] == SysexCommand.REPLACE_PATCH else ReplaceCurrentPatchCommand
+
+
+class Violation(_FrozenRecord):
+    __slots__ = ("path", "value", "message")
+
+    def __init__(self, path: str, value: object, message: str):
+        object.__setattr__(self, "path", path)
+        object.__setattr__(self, "value", value)
+        object.__setattr__(self, "message", message)
+
+
+class ValidationError(ValueError):
+    """A patch broke one or more of the rules checked by check(). See violations."""
+
+    def __init__(self, violations: list[Violation]):
+        self.violations = violations
+        super().__init__("; ".join(f"{v.path or 'patch'} {v.message} (Given {v.value!r})" for v in violations))
+
+    def __reduce__(self):
+        # Pickle as the violations, e.g. to raise from a worker process, since the message is built from them.
+        return type(self), (self.violations,)
+
+
+def validate(patch: PatchSysex, strict: bool = False):
+    """Raise a ValidationError listing every rule that check() finds the patch breaks."""
+    if _stats is not None:
+        return _timed(_stats, "validate", _validate, patch, strict)
+    _validate(patch, strict)
+
+
+def _validate(patch: PatchSysex, strict: bool):
+    violations = check(patch, strict)
+    if violations:
+        raise ValidationError(violations)
+
+
+def check(patch: PatchSysex, strict: bool = False) -> list[Violation]:
+    """
+    Every rule the patch breaks: list lengths, header and footer values, enum values,
+    and 7-bit data bytes. strict also requires the sysex start byte and zeroed reserved fields.
+    A PatchView or clone() is checked as its bytes, with the command type of its layout.
+    """
+    return _encode_checked(patch, strict)[1]
+
+
+def _encode_checked(patch, strict: bool = False) -> tuple[bytes | None, list[Violation]]:
+    # Encodes the patch once, for both check() and writing it. The buffer is None if the patch can't be encoded.
+    if isinstance(patch, _View):
+        buffer = bytes(patch)
+        return buffer, check_bytes(buffer, patch._codec.command_type, strict)
+    violations = [Violation(f.name, len(getattr(patch, f.name)), f"should have {f.metadata['list_len']} items")
+                  for f in fields(PatchSysex)
+                  if "list_len" in f.metadata and len(getattr(patch, f.name)) != f.metadata["list_len"]]
+    if violations:
+        return None, violations
+    try:
+        buffer = encode(patch)
+    except (struct.error, TypeError) as e:
+        return None, [Violation("", None, f"can't be encoded: {e}")]
+    return buffer, check_bytes(buffer, type(patch.command), strict)
+
+
+def check_bytes(buffer, command_type=ReplaceCurrentPatchCommand, strict: bool = False) -> list[Violation]:
+    """check() for an encoded patch, without decoding it."""
+    return _check_bytes(buffer, get_codec(command_type), strict)
+
+
+def _check_bytes(buffer, codec: "Codec", strict: bool = False) -> list[Violation]:
+    rules = _validation_rules(codec, strict)
+    if len(buffer) != len(rules.allowed):
+        return [Violation("", len(buffer), f"should be {len(rules.allowed)} bytes")]
+    # Fast path: every byte between the start and end bytes must be 7-bit, so only bytes with other rules need looking at.
+    if bytes(buffer[1:-1]).isascii() and all(allowed[buffer[offset]] for offset, allowed in rules.special):
+        return []
+    violations = {}
+    for offset in (i for i, (allowed, value) in enumerate(zip(rules.allowed, buffer)) if not allowed[value]):
+        for spec, allowed in rules.bitfields.get(offset, [(rules.specs[offset], None)]):
+            if spec.path in violations or allowed is not None and allowed[buffer[offset]]:
+                continue
+            if spec.mask:
+                value = (buffer[offset] & spec.mask) >> spec.shift
+            else:
+                value = buffer[spec.offset] if spec.size == 1 else bytes(buffer[spec.offset:spec.offset + spec.size])
+            violations[spec.path] = Violation(spec.path, value, rules.messages[spec.path])
+    return list(violations.values())
+
+
+def check_many(candidates, command_type=ReplaceCurrentPatchCommand, strict: bool = False):
+    """
+    check() many encoded patches, e.g. a PatchTable or (N, size) array, in one vectorized pass.
+    Returns the field paths, as check_bytes() names them, and an (N, len(paths)) bool array of which break a rule.
+    Valid patches are those with no True in their row. Requires NumPy.
+    """
+    import numpy as np
+    data = candidates.data if isinstance(candidates, PatchTable) else np.asarray(candidates, dtype=np.uint8)
+    rules = _validation_rules(get_codec(command_type), strict)
+    # Only the rows that fail the quick check need checking field by field.
+    suspect = _suspect_rows(data, rules)
+    rows = data[suspect]
+    allowed = np.array([list(a) for a in rules.allowed], dtype=bool)
+    invalid_bytes = ~allowed[np.arange(len(rules.allowed)), rows]
+    paths, columns = [], []
+    for spec in get_codec(command_type).fields:
+        if spec.offset in rules.bitfields:
+            # Bitfields with checked fields report the bitfield and those fields, as check_bytes() does.
+            for checked, rule in rules.bitfields[spec.offset]:
+                paths.append(checked.path)
+                columns.append(np.frombuffer(rule, dtype=np.uint8)[rows[:, spec.offset]] == 0)
+        else:
+            paths.append(spec.path)
+            columns.append(invalid_bytes[:, spec.offset:spec.offset + spec.size].any(axis=1))
+    invalid = np.zeros((len(data), len(paths)), dtype=bool)
+    invalid[suspect] = np.stack(columns, axis=1)
+    return paths, invalid
+
+
+def _suspect_rows(data, rules: "_Rules"):
+    # The fast path of _check_bytes() over an (N, size) array: which patches have a byte between the start
+    # and end bytes that isn't 7-bit, or a byte with another rule that it breaks. Others are valid.
+    import numpy as np
+    suspect = data[:, 1:-1].max(axis=1, initial=0) >= 0x80
+    for offset, allowed in rules.special:
+        suspect |= np.frombuffer(allowed, dtype=np.uint8)[data[:, offset]] == 0
+    return suspect
+
+
+class _Rules:
+    def __init__(self, codec: "Codec", strict: bool, allowed: list[bytes], special: list[tuple[int, bytes]]):
+        self._codec = codec
+        self._strict = strict
+        # For each byte of the patch: 256 flags of whether a value is allowed
+        self.allowed = allowed
+        # The offsets and allowed flags of bytes with rules other than being 7-bit data
+        self.special = special
+
+    # Fields and messages are only needed to report violations, so they're worked out when first needed.
+    @cached_property
+    def specs(self) -> list["FieldSpec"]:
+        """The field each byte of the patch is in"""
+        return [spec for spec in self._codec.fields for _ in range(spec.size)]
+
+    @cached_property
+    def messages(self) -> dict[str, str]:
+        """What each field's values should be, by path"""
+        messages = {spec.path: _byte_rule(self._codec._kinds[spec.offset], self._strict)[1] for spec in self._codec.fields}
+        for checked in self.bitfields.values():
+            messages.update((spec.path, f"should be a {spec.type.__name__}") for spec, _ in checked[1:])
+        return messages
+
+    @cached_property
+    def bitfields(self) -> dict[int, list[tuple["FieldSpec", bytes]]]:
+        """For each bitfield byte with rules for its fields: the bitfield and each of those fields, with their allowed flags"""
+        bitfields = {}
+        for spec in self._codec.fields:
+            if issubclass(spec.type, Structure):
+                checked = [(field_spec, _allow_bits(field_spec.type, field_spec.mask))
+                           for field_spec in _bitfield_specs(spec) if issubclass(field_spec.type, IntEnum)]
+                if checked:
+                    own_rule = _byte_rule(self._codec._kinds[spec.offset], self._strict)[0]
+                    bitfields[spec.offset] = [(spec, own_rule)] + checked
+        return bitfields
+
+
+# Which byte values are 7-bit data
+_SEVEN_BIT = bytes([1] * 0x80 + [0] * 0x80)
+
+
+@cache
+def _validation_rules(codec: "Codec", strict: bool) -> _Rules:
+    # Lists repeat the kinds of their items' bytes, so each kind's rule is worked out once.
+    rules, allowed = {}, []
+    for kind in codec._kinds:
+        rule = rules.get(kind)
+        if rule is None:
+            rule = _byte_rule(kind, strict)[0]
+            _, _, field_type, i = kind
+            if issubclass(field_type, Structure) and i == 0:
+                # Enum fields of bitfields are range-checked too, so a bitfield byte must pass its own rule and theirs.
+                enums = getattr(field_type, "_enums_", {})
+                for name, mask in _bitfield_masks(field_type).items():
+                    if issubclass(enums.get(name, int), IntEnum):
+                        # Each byte of the flags is 0 or 1, so and-ing them as integers and-s each byte.
+                        both = int.from_bytes(rule, "little") & int.from_bytes(_allow_bits(enums[name], mask), "little")
+                        rule = both.to_bytes(256, "little")
+            rules[kind] = rule
+        allowed.append(rule)
+    special = [(offset, rule) for offset, rule in enumerate(allowed) if rule != _SEVEN_BIT]
+    return _Rules(codec, strict, allowed, special)
+
+
+def _byte_rule(kind: tuple, strict: bool) -> tuple[bytes, str]:
+    """The values allowed in a byte of the kind _compile() records, and what its field should be."""
+    owner, name, field_type, i = kind
+    if owner is Header and name == "sysex":
+        return (_allow(0xf0), "should be 0xf0") if strict else (bytes([1] * 256), "")
+    elif owner is Header and name == "mfr_id":
+        return _allow(NOVATION_ID[i]), f"should be {NOVATION_ID!r}"
+    elif owner is Header and name == "prod_num":
+        return _allow(*sorted({prod_num for prod_num, _ in _layouts})), "should be a registered product number"
+    elif owner is Footer and name == "eox":
+        return _allow(0xf7), "should be 0xf7"
+    elif issubclass(field_type, IntEnum):
+        return _allow_enum(field_type), f"should be a {field_type.__name__}"
+    elif strict and "reserved" in name:
+        return _allow(0), "should be zero (reserved)"
+    return _SEVEN_BIT, "should be 7-bit data"
+
+
+@cache
+def _allow(*values) -> bytes:
+    allowed = bytearray(256)
+    for value in values:
+        allowed[value] = 1
+    return bytes(allowed)
+
+
+@cache
+def _allow_enum(enum_type: type[IntEnum]) -> bytes:
+    # The value map is quicker to iterate than the enum.
+    return _allow(*enum_type._value2member_map_)
+
+
+@cache
+def _allow_bits(enum_type: type[IntEnum], mask: int) -> bytes:
+    # Which byte values hold a value of the enum in the masked bits
+    shift = _lowest_bit(mask)
+    values = enum_type._value2member_map_
+    return bytes([(value & mask) >> shift in values for value in range(256)])
 
 
 def decode(buffer: bytes) -> PatchSysex:
+    """Decode an encoded patch with the codec of its layout. See codec_for()."""
+    return codec_for(buffer).decode(buffer)
+
+
+def encode(obj) -> bytes:
+    if isinstance(obj, PatchSysex):
+        return get_codec(type(obj.command)).encode(obj)
+    elif isinstance(obj, _View):
+        return bytes(obj)
+    return _encode(obj, {})
+
+
+def decode_reference(buffer: bytes) -> PatchSysex:
+    """Decode by walking the PatchSysex fields recursively. Slow, but simple to check the compiled codec against."""
     read_buf = BytesBuf(buffer)
     return _decode(PatchSysex, {}, read_buf)
 
 
+def encode_reference(obj) -> bytes:
+    """Encode by walking the dataclass fields recursively. See decode_reference()."""
+    return _encode(obj, {})
+
+
 def _decode(field_type, metadata, read_buf: BytesBuf):
     if metadata:
         return metadata["decode"](field_type, read_buf)
@@ -523,10 +1694,6 @@ def _decode(field_type, metadata, read_buf: BytesBuf):
         return field_type(*read_buf.unpack("B"))
 
 
-def encode(obj) -> bytes:
-    return _encode(obj, {})
-
-
 def _encode(obj, metadata) -> bytes:
     if metadata:
         return metadata["encode"](obj)
@@ -535,3 +1702,1684 @@ def _encode(obj, metadata) -> bytes:
     else:
         # If no metadata & not a dataclass, pack an int or enum into a byte
         return struct.pack("B", obj)
+
+
+class _Plan:
+    __slots__ = ("format", "kinds", "build", "flatten", "convert")
+
+    def __init__(self, format: str, kinds: list[tuple], build: Callable, flatten: Callable,
+                 convert: Callable | None = None):
+        self.format = format
+        # For each byte, what its validation rule depends on: the dataclass and name of the single-item field it's in,
+        # the field's type, and the byte's index in the field. See _byte_rule().
+        self.kinds = kinds
+        # Builds a field value, consuming its items from an iterator over the unpacked values.
+        self.build = build
+        # Appends a field value's items to a list of values to pack.
+        self.flatten = flatten
+        # For single-item fields, converts the unpacked item to the field value.
+        self.convert = convert
+
+
+class Codec:
+    """
+    A dataclass layout compiled to a single struct.Struct, so that a patch
+    decodes with one unpack_from() call and encodes with one pack_into() call.
+    """
+
+    def __init__(self, patch_type=PatchSysex, command_type=None):
+        # command_type overrides the type given to read_type(), e.g. to decode a ReplacePatchCommand.
+        plan = _compile(patch_type, {}, command_type)
+        self.struct = struct.Struct("<" + plan.format)
+        self.size = self.struct.size
+        self._kinds = plan.kinds
+        self.command_type = command_type
+        self._type = patch_type
+        self._build = plan.build
+        self._flatten = plan.flatten
+        # Stat names and builders of the top level fields, compiled when first decoding with stats enabled
+        self._sections = None
+
+    # The field specs are made when first needed, since reading and checking patches doesn't need them.
+    @cached_property
+    def fields(self) -> list["FieldSpec"]:
+        return _field_specs(self._type, {}, self.command_type, "", 0)
+
+    @cached_property
+    def index(self) -> dict[str, "FieldSpec"]:
+        """The fields, and the fields of bitfields, by path"""
+        index = {}
+        for spec in self.fields:
+            index[spec.path] = spec
+            if issubclass(spec.type, Structure):
+                index.update((bit_spec.path, bit_spec) for bit_spec in _bitfield_specs(spec))
+        return index
+
+    def decode(self, buffer, offset: int = 0):
+        if _stats is not None:
+            return self._decode_timed(buffer, offset, _stats)
+        try:
+            return self._build(iter(self.struct.unpack_from(buffer, offset)))
+        except KeyError:
+            raise self._enum_error(buffer, offset) from None
+
+    def _decode_timed(self, buffer, offset: int, stats: Stats):
+        # decode(), building each top level field separately to time it.
+        if self._sections is None:
+            self._sections = [(f"decode.{f.name}", _compile(f.type, f.metadata, self.command_type).build)
+                              for f in fields(self._type)]
+        start = lap = time.perf_counter()
+        try:
+            values = iter(self.struct.unpack_from(buffer, offset))
+            args = []
+            for name, build in self._sections:
+                args.append(build(values))
+                now = time.perf_counter()
+                stats.add(name, now - lap)
+                lap = now
+            return self._type(*args)
+        except KeyError:
+            raise self._enum_error(buffer, offset) from None
+        finally:
+            stats.add("decode", time.perf_counter() - start)
+
+    def _enum_error(self, buffer, offset: int) -> ValueError:
+        # Enums are looked up in their value maps, rather than called, for speed. So find the field that failed.
+        for spec in self.fields:
+            if issubclass(spec.type, IntEnum):
+                value = int(buffer[offset + spec.offset])
+                if value not in spec.type._value2member_map_:
+                    return ValueError(f"{value} is not a valid {spec.type.__name__} ({spec.path})")
+        return ValueError("Invalid enum value")
+
+    def encode(self, patch) -> bytes:
+        if _stats is not None:
+            return _timed(_stats, "encode", self._encode, patch)
+        return self.struct.pack(*self.values(patch))
+
+    def _encode(self, patch) -> bytes:
+        return self.struct.pack(*self.values(patch))
+
+    def encode_into(self, buffer, offset: int, patch):
+        if _stats is not None:
+            return _timed(_stats, "encode", self._encode_into, buffer, offset, patch)
+        self.struct.pack_into(buffer, offset, *self.values(patch))
+
+    def _encode_into(self, buffer, offset: int, patch):
+        self.struct.pack_into(buffer, offset, *self.values(patch))
+
+    def values(self, patch) -> list:
+        values = []
+        self._flatten(patch, values)
+        return values
+
+    def span(self, path: str) -> tuple[int, int]:
+        """The start and end offsets of a field, list or section, e.g. span("mod_matrix") or span("lfos[1]")."""
+        specs = [spec for spec in self.fields
+                 if spec.path == path or spec.path.startswith((path + ".", path + "["))]
+        if not specs:
+            raise KeyError(path)
+        return specs[0].offset, specs[-1].offset + specs[-1].size
+
+
+class FieldSpec(_FrozenRecord):
+    """Where a single-item field lives in the encoded bytes, e.g. path="oscillators[1].wave"."""
+    __slots__ = ("path", "offset", "size", "format", "type", "mask")
+
+    def __init__(self, path: str, offset: int, size: int, format: str, type: type, mask: int | None = None):
+        object.__setattr__(self, "path", path)
+        object.__setattr__(self, "offset", offset)
+        object.__setattr__(self, "size", size)
+        object.__setattr__(self, "format", format)
+        object.__setattr__(self, "type", type)
+        # The field's bits, for fields of bitfields. e.g. path="lfos[1].flags.key_sync"
+        object.__setattr__(self, "mask", mask)
+
+    @property
+    def shift(self) -> int:
+        return _lowest_bit(self.mask) if self.mask else 0
+
+
+def get_codec(command_type=ReplaceCurrentPatchCommand) -> Codec:
+    return _codec(command_type)
+
+
+@cache
+def _codec(command_type) -> Codec:
+    # Cached by the positional argument, so that get_codec() and get_codec(ReplaceCurrentPatchCommand) share a Codec.
+    return Codec(PatchSysex, command_type)
+
+
+# The patch and command types of encoded patches, by their product number and sysex command bytes.
+# Codecs are compiled when a layout is first used. See register_layout().
+_layouts: dict[tuple[int, int], tuple[type, type]] = {}
+_layout_codecs: dict[tuple[int, int], Codec] = {}
+
+
+def register_layout(prod_num: int, command_id: int, command_type, patch_type=PatchSysex):
+    """
+    Decode encoded patches whose header has prod_num, and whose command starts with command_id,
+    as patch_type with the command as command_type, e.g. for another device or sysex command.
+    """
+    _layouts[prod_num, command_id] = (patch_type, command_type)
+    _layout_codecs.pop((prod_num, command_id), None)
+    _validation_rules.cache_clear()
+
+
+for _prod_num in CIRCUIT_TRACKS_ID, CIRCUIT_ORIGINAL_ID:
+    register_layout(_prod_num, SysexCommand.REPLACE_CURRENT_PATCH, ReplaceCurrentPatchCommand)
+    register_layout(_prod_num, SysexCommand.REPLACE_PATCH, ReplacePatchCommand)
+
+
+def codec_for(buffer) -> Codec:
+    """
+    The codec of an encoded patch's registered layout, looked up by its product number and sysex command bytes,
+    or the default codec if it has none (so that check_bytes() reports its header).
+    """
+    key = (buffer[5], buffer[6]) if len(buffer) > 6 else None
+    codec = _layout_codecs.get(key)
+    if codec is None:
+        if key not in _layouts:
+            return get_codec()
+        patch_type, command_type = _layouts[key]
+        codec = get_codec(command_type) if patch_type is PatchSysex else Codec(patch_type, command_type)
+        _layout_codecs[key] = codec
+    return codec
+
+
+def field_index(command_type=ReplaceCurrentPatchCommand) -> dict[str, FieldSpec]:
+    """Every field of the encoded patch by path, including fields of bitfields."""
+    return get_codec(command_type).index
+
+
+def get_field(buffer, path: str, command_type=ReplaceCurrentPatchCommand):
+    """Read a field from an encoded patch, e.g. get_field(buffer, "macro_knobs[3].ranges[2].depth")."""
+    spec = get_codec(command_type).index[path]
+    offset = spec.offset
+    if spec.mask:
+        return (int.from_bytes(buffer[offset:offset + spec.size], "little") & spec.mask) >> spec.shift
+    elif spec.format == "B":
+        return spec.type(buffer[offset])
+    elif issubclass(spec.type, Structure):
+        return spec.type.from_buffer_copy(bytes(buffer[offset:offset + spec.size]))
+    else:
+        return spec.type(*struct.unpack_from(spec.format, buffer, offset))
+
+
+class FieldChange(_FrozenRecord):
+    __slots__ = ("path", "old", "new")
+
+    def __init__(self, path: str, old: object, new: object):
+        object.__setattr__(self, "path", path)
+        object.__setattr__(self, "old", old)
+        object.__setattr__(self, "new", new)
+
+
+def diff(a, b, command_type=ReplaceCurrentPatchCommand) -> list[FieldChange]:
+    """
+    The fields that differ between two encoded patches, in layout order.
+    Bitfields are compared by their fields, e.g. path="lfos[1].flags.key_sync".
+    """
+    if a == b:
+        return []
+    specs_at = _diff_specs_at(command_type)
+    changes = {}
+    for offset in (i for i, (x, y) in enumerate(zip(a, b)) if x != y):
+        for spec in specs_at[offset]:
+            if spec.path not in changes:
+                old, new = get_field(a, spec.path, command_type), get_field(b, spec.path, command_type)
+                if old != new:
+                    changes[spec.path] = FieldChange(spec.path, old, new)
+    return list(changes.values())
+
+
+def apply(buffer, delta: list[FieldChange], command_type=ReplaceCurrentPatchCommand):
+    """Write the new values of a diff() to an encoded patch, in place. Returns the buffer."""
+    for change in delta:
+        set_field(buffer, change.path, change.new, command_type)
+    return buffer
+
+
+def diff_many(reference, candidates, command_type=ReplaceCurrentPatchCommand):
+    """
+    Compare an encoded patch to many, e.g. a PatchTable or (N, size) array, in one vectorized pass.
+    Returns the field paths, as diff() would name them, and an (N, len(paths)) bool array of which differ.
+    Requires NumPy.
+    """
+    import numpy as np
+    data = candidates.data if isinstance(candidates, PatchTable) else np.asarray(candidates, dtype=np.uint8)
+    specs = _diff_specs(command_type)
+    changed_bytes = data ^ np.frombuffer(bytes(reference), dtype=np.uint8)
+    changed = np.empty((len(data), len(specs)), dtype=bool)
+    single = [i for i, spec in enumerate(specs) if spec.size == 1]
+    offsets = [specs[i].offset for i in single]
+    masks = np.array([specs[i].mask or 0xff for i in single], dtype=np.uint8)
+    changed[:, single] = changed_bytes[:, offsets] & masks != 0
+    for i, spec in enumerate(specs):
+        if spec.size > 1:
+            changed[:, i] = changed_bytes[:, spec.offset:spec.offset + spec.size].any(axis=1)
+    return [spec.path for spec in specs], changed
+
+
+@cache
+def _diff_specs(command_type) -> list[FieldSpec]:
+    # Fields, with bitfields replaced by their fields
+    return [spec for spec in get_codec(command_type).index.values() if not issubclass(spec.type, Structure)]
+
+
+@cache
+def _diff_specs_at(command_type) -> list[list[FieldSpec]]:
+    specs_at = [[] for _ in range(get_codec(command_type).size)]
+    for spec in _diff_specs(command_type):
+        for offset in range(spec.offset, spec.offset + spec.size):
+            specs_at[offset].append(spec)
+    return specs_at
+
+
+# The sections that make the sound. Excludes the header, command, meta (name, category, genre) and footer.
+SOUND_SECTIONS = ("voice", "oscillators", "mixer", "filter", "envelopes", "lfos", "fx", "mod_matrix", "macro_knobs")
+
+
+def sound_hash(buffer, command_type=ReplaceCurrentPatchCommand) -> bytes:
+    """
+    A hash of the sound sections of an encoded patch, equal for patches that sound
+    the same but differ in name, sysex command, target slot or product number.
+    """
+    import hashlib
+    start, end = _sound_span(command_type)
+    return hashlib.blake2b(buffer[start:end], digest_size=16).digest()
+
+
+@cache
+def _sound_span(command_type) -> tuple[int, int]:
+    codec = get_codec(command_type)
+    return codec.span(SOUND_SECTIONS[0])[0], codec.span(SOUND_SECTIONS[-1])[1]
+
+
+def set_field(buffer, path: str, value, command_type=ReplaceCurrentPatchCommand):
+    """Write a field of an encoded patch in place, e.g. set_field(buffer, "lfos[1].flags.key_sync", 1)."""
+    spec = get_codec(command_type).index[path]
+    offset = spec.offset
+    if spec.mask:
+        bits = int.from_bytes(buffer[offset:offset + spec.size], "little") & ~spec.mask | (value << spec.shift) & spec.mask
+        buffer[offset:offset + spec.size] = bits.to_bytes(spec.size, "little")
+    elif spec.format == "B":
+        buffer[offset] = value
+    elif issubclass(spec.type, Structure):
+        buffer[offset:offset + spec.size] = bytes(value)
+    else:
+        buffer[offset:offset + spec.size] = struct.pack(spec.format, value)
+
+
+def _compile(field_type, metadata, command_type) -> _Plan:
+    if "list_len" in metadata:
+        length = metadata["list_len"]
+        item = _compile(field_type.__args__[0], {}, command_type)
+        build_item, flatten_item = item.build, item.flatten
+
+        def build(values):
+            return [build_item(values) for _ in range(length)]
+
+        def flatten(obj_list, out):
+            for obj in obj_list:
+                flatten_item(obj, out)
+
+        return _Plan(item.format * length, item.kinds * length, build, flatten)
+    elif "read_type" in metadata:
+        return _compile(command_type or metadata["read_type"], {}, command_type)
+    elif is_dataclass(field_type):
+        dataclass_fields = fields(field_type)
+        names = [f.name for f in dataclass_fields]
+        plans = [_compile(f.type, f.metadata, command_type) for f in dataclass_fields]
+        format = "".join(plan.format for plan in plans)
+        kinds = []
+        for name, plan in zip(names, plans):
+            if plan.kinds[0][0] is None:
+                # A single-item field, or list of them, is named by the dataclass it's in.
+                kinds += [(field_type, name, kind_type, i) for _, _, kind_type, i in plan.kinds]
+            else:
+                kinds += plan.kinds
+        converts = [plan.convert for plan in plans]
+        flattens = list(zip(names, (plan.flatten for plan in plans)))
+
+        def flatten(obj, out):
+            for name, flatten_field in flattens:
+                flatten_field(getattr(obj, name), out)
+
+        if None in converts:
+            builds = [plan.build for plan in plans]
+
+            def build(values):
+                return field_type(*[build_field(values) for build_field in builds])
+        else:
+            # All fields are single items, so convert them in one pass.
+            def build(values):
+                return field_type(*[convert(value) for convert, value in zip(converts, values)])
+
+        return _Plan(format, kinds, build, flatten)
+    else:
+        if "bitfield" in metadata:
+            convert = field_type.from_buffer_copy
+            flatten = _append_bytes
+        else:
+            # Explicitly formatted fields, or single bytes read into an int or enum
+            convert = field_type._value2member_map_.__getitem__ if issubclass(field_type, IntEnum) else field_type
+            flatten = _append
+        format = metadata.get("format", "B")
+        kinds = [(None, None, field_type, i) for i in range(struct.calcsize(format))]
+        return _Plan(format.lstrip("<>=!@"), kinds, lambda values: convert(next(values)), flatten, convert)
+
+
+def _append(obj, out):
+    out.append(obj)
+
+
+def _append_bytes(obj, out):
+    out.append(bytes(obj))
+
+
+def _field_specs(field_type, metadata, command_type, path: str, offset: int) -> list[FieldSpec]:
+    if "list_len" in metadata:
+        specs = []
+        for i in range(metadata["list_len"]):
+            item_specs = _field_specs(field_type.__args__[0], {}, command_type, f"{path}[{i}]", offset)
+            offset = item_specs[-1].offset + item_specs[-1].size
+            specs += item_specs
+        return specs
+    elif "read_type" in metadata:
+        return _field_specs(command_type or metadata["read_type"], {}, command_type, path, offset)
+    elif is_dataclass(field_type):
+        specs = []
+        for f in fields(field_type):
+            field_specs = _field_specs(f.type, f.metadata, command_type, f"{path}.{f.name}" if path else f.name, offset)
+            offset = field_specs[-1].offset + field_specs[-1].size
+            specs += field_specs
+        return specs
+    else:
+        format = metadata.get("format", "B")
+        return [FieldSpec(path, offset, struct.calcsize(format), format, field_type)]
+
+
+def _bitfield_specs(spec: FieldSpec) -> list[FieldSpec]:
+    """The fields of a bitfield, e.g. lfos[1].flags.key_sync of lfos[1].flags."""
+    enums = getattr(spec.type, "_enums_", {})
+    return [FieldSpec(f"{spec.path}.{name}", spec.offset, spec.size, spec.format, enums.get(name, int), mask)
+            for name, mask in _bitfield_masks(spec.type).items()]
+
+
+class PatchTable:
+    """
+    Many patches in one (N, size) uint8 NumPy array, with every single-item field
+    available as a named column view, e.g. table["filter.frequency"] or table["oscillators[1].wave"].
+    Columns are views, so assigning to them edits the patch bytes in place.
+    Fields of bitfields, e.g. table["lfos[0].flags.key_sync"], are computed columns: reading one gives
+    a new array, and assigning to one writes its bits in place. Requires NumPy.
+    """
+
+    def __init__(self, data, command_type=ReplaceCurrentPatchCommand):
+        import numpy as np
+        self.command_type = command_type
+        self.codec = get_codec(command_type)
+        self.data = np.ascontiguousarray(data, dtype=np.uint8).reshape(-1, self.codec.size)
+        self.records = self.data.view(_numpy_dtype(self.codec))[:, 0]
+
+    @classmethod
+    def from_bytes(cls, buffer: bytes, command_type=ReplaceCurrentPatchCommand) -> "PatchTable":
+        import numpy as np
+        return cls(np.frombuffer(buffer, dtype=np.uint8).copy(), command_type)
+
+    @classmethod
+    def from_patches(cls, patches, command_type=ReplaceCurrentPatchCommand) -> "PatchTable":
+        import numpy as np
+        codec = get_codec(command_type)
+        patches = list(patches)
+        data = np.empty((len(patches), codec.size), dtype=np.uint8)
+        for row, patch in zip(data, patches):
+            if isinstance(patch, _View):
+                row[:] = memoryview(bytes(patch))
+            else:
+                codec.encode_into(row, 0, patch)
+        return cls(data, command_type)
+
+    @classmethod
+    def from_files(cls, syx_filenames, command_type=ReplaceCurrentPatchCommand) -> "PatchTable":
+        return cls.from_bytes(b"".join(Path(f).read_bytes() for f in syx_filenames), command_type)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, path: str):
+        spec = self.codec.index.get(path)
+        if spec is not None and spec.mask:
+            return (self.data[:, spec.offset] & spec.mask) >> spec.shift
+        return self.records[path]
+
+    def __setitem__(self, path: str, values):
+        import numpy as np
+        spec = self.codec.index.get(path)
+        if spec is not None and spec.mask:
+            # Bitfields are a single byte.
+            bits = (np.asarray(values, dtype=np.uint8) << spec.shift) & spec.mask
+            self.data[:, spec.offset] = self.data[:, spec.offset] & ~np.uint8(spec.mask) | bits
+        else:
+            self.records[path] = values
+
+    def columns(self) -> list[str]:
+        """Every column, including the fields of bitfields."""
+        return list(self.codec.index)
+
+    def patch(self, index: int) -> PatchSysex:
+        return self.codec.decode(self.data[index])
+
+    def patches(self):
+        for row in self.data:
+            yield self.codec.decode(row)
+
+    def tobytes(self) -> bytes:
+        """All patches as concatenated sysex records."""
+        return self.data.tobytes()
+
+    def write_syx(self, syx_filenames):
+        for row, syx_filename in zip(self.data, syx_filenames):
+            with open(syx_filename, "wb") as f:
+                f.write(row)
+
+
+class SimilarityIndex:
+    """
+    Finds the patches that sound most like a given patch, by a weighted distance over
+    the fields of the sound sections. Numeric fields (and the fields of bitfields) are
+    compared by their difference scaled to 0...1. Enum fields are categorical: they add
+    1 to the distance if they differ, like half the squared distance of a one-hot encoding.
+    Reserved fields are ignored. Requires NumPy.
+
+        index = SimilarityIndex.from_table(PatchTable.from_files(files), keys=files)
+        index.save("library.npz")
+        for key, distance in SimilarityIndex.load("library.npz").query(patch, k=5, weights={"filter": 2}):
+            print(key, distance)
+    """
+
+    def __init__(self, features, keys=None, command_type=ReplaceCurrentPatchCommand):
+        import numpy as np
+        self.command_type = command_type
+        self.specs = _feature_specs(command_type)
+        # (N, len(specs)) uint8 field values
+        self.features = np.asarray(features, dtype=np.uint8)
+        self.keys = list(range(len(self.features)) if keys is None else keys)
+        self._categorical = np.array([issubclass(spec.type, IntEnum) for spec in self.specs])
+        self._sections = np.array([_section(spec.path) for spec in self.specs])
+        # Numeric fields scaled to 0...1, and their squares, so that weighted
+        # distances are sum(w * x**2) - 2 * sum(w * x * y) + sum(w * y**2), computed as matrix products.
+        scale = np.array([1 / ((spec.mask >> spec.shift) if spec.mask else 127) for spec in self.specs],
+                         dtype=np.float32)
+        self._numeric = self.features[:, ~self._categorical] * scale[~self._categorical]
+        self._numeric_squared = self._numeric ** 2
+        self._categories = self.features[:, self._categorical]
+
+    @classmethod
+    def from_table(cls, table: PatchTable, keys=None) -> "SimilarityIndex":
+        import numpy as np
+        specs = _feature_specs(table.command_type)
+        features = np.empty((len(table), len(specs)), dtype=np.uint8)
+        for i, spec in enumerate(specs):
+            features[:, i] = (table.data[:, spec.offset] & (spec.mask or 0xff)) >> spec.shift
+        return cls(features, keys, table.command_type)
+
+    @classmethod
+    def load(cls, npz_filename: str | Path) -> "SimilarityIndex":
+        import numpy as np
+        with np.load(npz_filename, allow_pickle=False) as npz:
+            name = str(npz["command_type"])
+            # Only the command types of registered layouts, rather than any name the file gives
+            command_types = {command_type.__name__: command_type for _, command_type in _layouts.values()}
+            if name not in command_types:
+                raise ValueError(f"'{npz_filename}' has an unknown command type '{name}'")
+            return cls(npz["features"], npz["keys"].tolist(), command_types[name])
+
+    def save(self, npz_filename: str | Path):
+        import numpy as np
+        np.savez_compressed(npz_filename, features=self.features, keys=np.array([str(k) for k in self.keys]),
+                            command_type=self.command_type.__name__)
+
+    def __len__(self):
+        return len(self.features)
+
+    def query(self, patch, k: int = 10, weights: dict[str, float] | None = None, chunk_size: int = 65536):
+        """
+        The k nearest patches to a PatchSysex or encoded patch, as (key, distance) pairs, nearest first.
+        weights scales the distance of sections, e.g. {"filter": 2, "macro_knobs": 0}.
+        """
+        import numpy as np
+        if isinstance(patch, PatchSysex):
+            patch = encode(patch)
+        table = PatchTable.from_bytes(bytes(patch), self.command_type)
+        target = SimilarityIndex.from_table(table)
+
+        column_weights = np.ones(len(self.specs), dtype=np.float32)
+        for section, weight in (weights or {}).items():
+            column_weights[self._sections == section] = weight
+        numeric_weights = column_weights[~self._categorical]
+        categorical_weights = column_weights[self._categorical]
+        target_numeric = target._numeric[0]
+        target_categories = target._categories[0]
+
+        distances = np.empty(len(self.features), dtype=np.float32)
+        for start in range(0, len(self.features), chunk_size):
+            end = start + chunk_size
+            distances[start:end] = (
+                self._numeric_squared[start:end] @ numeric_weights
+                - self._numeric[start:end] @ (2 * numeric_weights * target_numeric)
+                + (self._categories[start:end] != target_categories) @ categorical_weights)
+        distances += target_numeric ** 2 @ numeric_weights
+        np.maximum(distances, 0, out=distances)
+
+        k = min(k, len(distances))
+        nearest = np.argpartition(distances, k - 1)[:k] if k else []
+        nearest = sorted(nearest, key=lambda i: distances[i])
+        return [(self.keys[i], float(distances[i])) for i in nearest]
+
+
+class Query:
+    """
+    A filter expression over the fields of patches, compiled to a vectorized NumPy predicate
+    over their encoded bytes, so that patches are never decoded. For example:
+
+        Query("filter.type == LOW_PASS_24DB and mixer.osc2_level > 0 and any(mod_matrix.destination == FILTER_FREQUENCY)")
+
+    Fields are named by path, as for get_field(). Leaving out a list index, as in mod_matrix.destination,
+    gives that field of every item, which any() or all() reduce to one value per patch.
+    Enum names are looked up in the enum type of the field they're compared with, or may be qualified,
+    e.g. FilterType.LOW_PASS_24DB. Text equals a bytes field, such as meta.name, if it fills the field
+    up to padding spaces or zeros. Expressions may use and, or, not, comparisons (chained, and "in" a tuple),
+    + - * // % and abs(). Requires NumPy.
+    """
+
+    def __init__(self, expression: str, command_type=ReplaceCurrentPatchCommand):
+        import ast
+        self.expression = expression
+        self.command_type = command_type
+        self.codec = get_codec(command_type)
+        term = self._compile(ast.parse(expression.strip(), mode="eval").body)
+        if term.items:
+            raise ValueError(f"'{expression}' gives {term.items} values per patch. Use any() or all().")
+        self._predicate = term.func
+
+    def mask(self, candidates):
+        """
+        Whether each patch matches, for a PatchTable, SyxBank, (N, size) array or concatenated
+        patch bytes. Messages of a SyxBank that aren't patches of this command type don't match.
+        """
+        import numpy as np
+        if not isinstance(candidates, SyxBank):
+            return self._evaluate(_patch_array(candidates, self.codec.size))
+        starts = np.frombuffer(candidates.starts, dtype=np.int64)
+        ends = np.frombuffer(candidates.ends, dtype=np.int64)
+        patches = ends - starts == self.codec.size
+        buffer = np.frombuffer(candidates._buffer, dtype=np.uint8)
+        mask = np.zeros(len(starts), dtype=bool)
+        mask[patches] = self._evaluate(buffer[starts[patches, None] + np.arange(self.codec.size)])
+        return mask
+
+    def indices(self, candidates):
+        """The indices of the patches that match. See mask()."""
+        import numpy as np
+        return np.flatnonzero(self.mask(candidates))
+
+    def paths(self, syx_filenames, chunk_size: int = 4096) -> list[Path]:
+        """The .syx files that match, read chunk_size files at a time. Files of the wrong size don't match."""
+        paths = [Path(f) for f in syx_filenames]
+        matches = []
+        for i in range(0, len(paths), chunk_size):
+            chunk = [(path, path.read_bytes()) for path in paths[i:i + chunk_size]]
+            chunk = [(path, buffer) for path, buffer in chunk if len(buffer) == self.codec.size]
+            mask = self._evaluate(_patch_array(b"".join(buffer for _, buffer in chunk), self.codec.size))
+            matches += [path for (path, _), match in zip(chunk, mask) if match]
+        return matches
+
+    def _evaluate(self, data):
+        import numpy as np
+        # Expressions without fields give one value for every patch.
+        return np.broadcast_to(self._predicate(data), (len(data),)).astype(bool)
+
+    def _compile(self, node, context=None) -> "_Term":
+        # context is the type of the field that node is compared with, to look enum names up in.
+        import ast
+        import numpy as np
+        op = type(node.op).__name__ if isinstance(node, (ast.BoolOp, ast.BinOp, ast.UnaryOp)) else None
+        if isinstance(node, ast.BoolOp):
+            term = self._compile(node.values[0])
+            for value in node.values[1:]:
+                term = _combine(np.logical_and if op == "And" else np.logical_or, term, self._compile(value))
+            return term
+        elif op in ("Not", "USub"):
+            operand = self._compile(node.operand, context)
+            negate = np.logical_not if op == "Not" else np.negative
+            return _Term(lambda data: negate(operand.func(data)), operand.items)
+        elif op in _QUERY_OPERATORS:
+            left = self._compile(node.left, context)
+            right = self._compile(node.right, left.field_type or context)
+            if left.size or right.size:
+                raise ValueError(f"Text can only be compared with == or !=. (Given '{ast.unparse(node)}')")
+            return _combine(_QUERY_OPERATORS[op], left, right)
+        elif isinstance(node, ast.Compare):
+            left = self._compile(node.left, context)
+            term = None
+            for op, comparator in zip(node.ops, node.comparators):
+                op = type(op).__name__
+                if op in ("In", "NotIn") and isinstance(comparator, (ast.Tuple, ast.List, ast.Set)):
+                    values = [self._constant(item, left.field_type) for item in comparator.elts]
+                    compared = _Term(_isin(left.func, values, op == "NotIn"), left.items)
+                    right = left
+                elif op in _QUERY_COMPARISONS:
+                    right = self._compile(comparator, left.field_type)
+                    if left.size or right.size:
+                        compared = _compare_bytes(left, right, op, ast.unparse(node))
+                    else:
+                        compared = _combine(_QUERY_COMPARISONS[op], left, right)
+                else:
+                    raise ValueError(f"Unsupported comparison in '{ast.unparse(node)}'")
+                term = compared if term is None else _combine(np.logical_and, term, compared)
+                left = right
+            return term
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and len(node.args) == 1:
+            arg = self._compile(node.args[0], context)
+            if node.func.id in ("any", "all"):
+                if not arg.items:
+                    raise ValueError(f"{node.func.id}() needs a field of every list item, e.g. mod_matrix.destination. "
+                                     f"(Given '{ast.unparse(node)}')")
+                reduce = np.any if node.func.id == "any" else np.all
+                return _Term(lambda data: reduce(arg.func(data), axis=1))
+            elif node.func.id == "abs":
+                return _Term(lambda data: np.abs(arg.func(data)), arg.items)
+        elif isinstance(node, (ast.Name, ast.Attribute, ast.Subscript)):
+            path = _query_path(node)
+            specs = [spec for spec in self.codec.index.values() if path and _query_path_matches(spec.path, path)]
+            if not specs and path:
+                # Properties name the underscored fields they wrap, e.g. meta.name is meta._name.
+                path = path[:-1] + [("_" + path[-1][0], path[-1][1])]
+                specs = [spec for spec in self.codec.index.values() if _query_path_matches(spec.path, path)]
+            if specs:
+                return _column(specs, ast.unparse(node))
+            value = self._constant(node, context)
+            return _Term(lambda data: value)
+        elif isinstance(node, ast.Constant):
+            value = self._constant(node, context)
+            return _Term(lambda data: value, size=len(value) if isinstance(value, bytes) else 0)
+        raise ValueError(f"Unsupported expression '{ast.unparse(node)}'")
+
+    def _constant(self, node, context):
+        import ast
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, str, bytes)):
+            return node.value.encode("ascii") if isinstance(node.value, str) else node.value
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub) and isinstance(node.operand, ast.Constant):
+            return -node.operand.value
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+            enum_type = globals().get(node.value.id)
+            if isinstance(enum_type, type) and issubclass(enum_type, IntEnum) and node.attr in enum_type.__members__:
+                return enum_type[node.attr]
+        if isinstance(node, ast.Name):
+            if isinstance(context, type) and issubclass(context, IntEnum) and node.id in context.__members__:
+                return context[node.id]
+            members = [enum_type[node.id] for enum_type in _query_enums(self.command_type)
+                       if node.id in enum_type.__members__]
+            if len(members) == 1:
+                return members[0]
+            elif members:
+                raise ValueError(f"'{node.id}' is in {len(members)} enums. Compare it with a field, or qualify it, "
+                                 f"e.g. {type(members[0]).__name__}.{node.id}")
+        raise ValueError(f"Unknown field or value '{ast.unparse(node)}'")
+
+
+def select(expression: str, source, command_type=ReplaceCurrentPatchCommand):
+    """
+    Patches that match a Query expression. For a directory, returns the paths of its .syx files that match.
+    For a bank .syx file, PatchTable, (N, size) array or concatenated patch bytes, returns the indices that match.
+    """
+    query = _compile_query(expression, command_type)
+    if isinstance(source, (str, Path)):
+        if Path(source).is_dir():
+            return query.paths(sorted(Path(source).glob("*.syx")))
+        with SyxBank(source, command_type) as bank:
+            return query.indices(bank)
+    return query.indices(source)
+
+
+@lru_cache(maxsize=256)
+def _compile_query(expression: str, command_type) -> Query:
+    # Queries hold no state from their use, so select() reuses them for repeated expressions.
+    return Query(expression, command_type)
+
+
+class _Term:
+    """A compiled part of a Query."""
+    __slots__ = ("func", "items", "field_type", "size")
+
+    def __init__(self, func: Callable, items: int = 0, field_type: type | None = None, size: int = 0):
+        # Gives the part's values from the (N, size) array of patches: an (N,) array, an (N, items) array, or a constant.
+        self.func = func
+        # The number of values per patch of a field of every list item, otherwise 0
+        self.items = items
+        # The field's type, to look enum names up in
+        self.field_type = field_type
+        # The size of a bytes field or text, otherwise 0
+        self.size = size
+
+
+_QUERY_OPERATORS = {"Add": operator.add, "Sub": operator.sub, "Mult": operator.mul,
+                    "FloorDiv": operator.floordiv, "Mod": operator.mod}
+_QUERY_COMPARISONS = {"Eq": operator.eq, "NotEq": operator.ne, "Lt": operator.lt,
+                      "LtE": operator.le, "Gt": operator.gt, "GtE": operator.ge}
+
+
+def _combine(func, left: _Term, right: _Term) -> _Term:
+    if left.items and right.items and left.items != right.items:
+        raise ValueError(f"Can't combine fields of lists of {left.items} and {right.items} items")
+    left_func, right_func = left.func, right.func
+    if left.items or right.items:
+        # Compare a single value per patch with each list item.
+        return _Term(lambda data: func(_per_item(left_func(data)), _per_item(right_func(data))), left.items or right.items)
+    return _Term(lambda data: func(left_func(data), right_func(data)))
+
+
+def _per_item(values):
+    return values[:, None] if getattr(values, "ndim", 0) == 1 else values
+
+
+def _isin(func, values: list, invert: bool) -> Callable:
+    import numpy as np
+    return lambda data: np.isin(func(data), values, invert=invert)
+
+
+def _compare_bytes(left: _Term, right: _Term, op: str, expression: str) -> _Term:
+    import numpy as np
+    column, text = (left, right) if left.field_type is bytes else (right, left)
+    if column.field_type is not bytes or text.field_type is not None or not text.size or op not in ("Eq", "NotEq"):
+        raise ValueError(f"Text can only be compared with a bytes field, with == or !=. (Given '{expression}')")
+    column_func, value = column.func, text.func(None)
+    if len(value) > column.size:
+        return _Term(lambda data: np.full(len(data), op == "NotEq"))
+    expected = np.frombuffer(value, dtype=np.uint8)
+
+    def compare(data):
+        values = column_func(data)
+        equal = (values[:, :len(value)] == expected).all(axis=1) & np.isin(values[:, len(value):], (0x20, 0)).all(axis=1)
+        return equal if op == "Eq" else ~equal
+    return _Term(compare)
+
+
+def _column(specs: list[FieldSpec], expression: str) -> _Term:
+    import numpy as np
+    spec = specs[0]
+    if spec.type is bytes:
+        if len(specs) > 1:
+            raise ValueError(f"Text can't be compared with every list item. (Given '{expression}')")
+        return _Term(lambda data: data[:, spec.offset:spec.offset + spec.size], field_type=bytes, size=spec.size)
+    # An (N,) column of a single field, or an (N, items) column of a field of every list item
+    offsets = np.array([s.offset for s in specs]) if len(specs) > 1 else spec.offset
+
+    def column(data):
+        values = data[:, offsets].astype(np.int32)
+        for i in range(1, spec.size):
+            values |= data[:, offsets + i].astype(np.int32) << (8 * i)
+        return (values & spec.mask) >> spec.shift if spec.mask else values
+    return _Term(column, len(specs) if len(specs) > 1 else 0, spec.type)
+
+
+def _query_path(node) -> list[tuple[str, int | None]] | None:
+    """The (name, index) parts of an expression such as oscillators[1].wave, or None if it isn't a field path."""
+    import ast
+    if isinstance(node, ast.Name):
+        return [(node.id, None)]
+    elif isinstance(node, ast.Attribute):
+        path = _query_path(node.value)
+        return path and path + [(node.attr, None)]
+    elif isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, int):
+        path = _query_path(node.value)
+        if path and path[-1][1] is None:
+            return path[:-1] + [(path[-1][0], node.slice.value)]
+    return None
+
+
+def _query_path_matches(spec_path: str, path: list[tuple[str, int | None]]) -> bool:
+    parts = _path_parts(spec_path)
+    return len(parts) == len(path) and all(
+        name == query_name and (query_index is None or index == query_index)
+        for (name, index), (query_name, query_index) in zip(parts, path))
+
+
+@cache
+def _path_parts(spec_path: str) -> tuple[tuple[str, int | None], ...]:
+    parts = []
+    for part in spec_path.split("."):
+        name, _, index = part.partition("[")
+        parts.append((name, int(index[:-1]) if index else None))
+    return tuple(parts)
+
+
+@cache
+def _query_enums(command_type) -> list[type]:
+    return sorted({spec.type for spec in get_codec(command_type).fields if issubclass(spec.type, IntEnum)},
+                  key=lambda enum_type: enum_type.__name__)
+
+
+def _patch_array(candidates, size: int):
+    import numpy as np
+    if isinstance(candidates, PatchTable):
+        return candidates.data
+    elif isinstance(candidates, _View):
+        candidates = bytes(candidates)
+    if isinstance(candidates, (bytes, bytearray, memoryview)):
+        return np.frombuffer(candidates, dtype=np.uint8).reshape(-1, size)
+    return np.asarray(candidates, dtype=np.uint8).reshape(-1, size)
+
+
+def export_columns(source, filename: str | Path, command_type=ReplaceCurrentPatchCommand, chunk_size: int = 65536,
+                   labels: bool = True) -> int:
+    """
+    Write every leaf field of many patches as a column, to a .npz, .csv or .jsonl file, chunk_size patches at a time.
+    source is a PatchTable, a bank .syx file or SyxBank, a directory of .syx files, or an iterable of patches
+    or encoded patches. Columns are named by path, as for get_field(), in the order of the patch layout.
+    With labels, enum fields also have a "<path>:name" column of names, and bytes fields a "<path>:text" column.
+    In .csv and .jsonl files, bytes fields are written as hex. A .npz file has an array per column,
+    of every patch. Returns the number of patches written. Requires NumPy.
+    """
+    import numpy as np
+    suffix = Path(filename).suffix
+    if suffix not in (".npz", ".csv", ".jsonl"):
+        raise ValueError(f"Can't export to '{filename}'. Expected a .npz, .csv or .jsonl file.")
+    specs = _diff_specs(command_type)
+    chunks = _patch_chunks(source, command_type, chunk_size)
+    count = 0
+    if suffix == ".npz":
+        import tempfile
+        import zipfile
+        # Each column's chunks go to a temporary file, to be stored as one array once the last chunk is in.
+        with tempfile.TemporaryDirectory() as directory:
+            files, parts = {}, {}
+            try:
+                for data in chunks:
+                    for name, values in _columns(data, specs, labels).items():
+                        if name not in files:
+                            files[name] = open(os.path.join(directory, f"{len(files)}.bin"), "w+b")
+                            parts[name] = []
+                        files[name].write(values.tobytes())
+                        parts[name].append((values.dtype, len(values)))
+                    count += len(data)
+                with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as archive:
+                    _write_npy(archive, "command_type", np.array(command_type.__name__))
+                    for name, f in files.items():
+                        f.seek(0)
+                        _write_joined_npy(archive, name, f, parts[name])
+            finally:
+                for f in files.values():
+                    f.close()
+        return count
+
+    import csv
+    import json
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        for i, data in enumerate(chunks):
+            columns = _columns(data, specs, labels)
+            rows = zip(*(_text_values(values) for values in columns.values()))
+            if suffix == ".csv":
+                if i == 0:
+                    writer.writerow(columns)
+                writer.writerows(rows)
+            else:
+                names = list(columns)
+                f.writelines(json.dumps(dict(zip(names, row))) + "\n" for row in rows)
+            count += len(data)
+    return count
+
+
+def import_columns(filename: str | Path, command_type=ReplaceCurrentPatchCommand, chunk_size: int = 65536):
+    """
+    Rebuild the encoded patches of a file written by export_columns(), yielding a PatchTable per chunk.
+    Fields are read from their value columns, or from their ":name" column of enum names if there's no value.
+    Raises a ValueError for a missing field or a rebuilt patch that check() finds invalid. Requires NumPy.
+    """
+    import numpy as np
+    suffix = Path(filename).suffix
+    specs = _diff_specs(command_type)
+    if suffix == ".npz":
+        with np.load(filename, allow_pickle=False) as npz:
+            columns = {name: npz[name] for name in npz.files if name != "command_type"}
+        count = len(next(iter(columns.values()), ()))
+        for start in range(0, count, chunk_size):
+            yield _rebuild(specs, lambda name: columns[name][start:start + chunk_size] if name in columns else None,
+                           command_type)
+        return
+
+    with open(filename, newline="") as f:
+        if suffix == ".csv":
+            import csv
+            rows = csv.DictReader(f)
+        elif suffix == ".jsonl":
+            import json
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            raise ValueError(f"Can't import '{filename}'. Expected a .npz, .csv or .jsonl file.")
+        while chunk := [row for _, row in zip(range(chunk_size), rows)]:
+            yield _rebuild(specs, lambda name: [row[name] for row in chunk] if name in chunk[0] else None, command_type)
+
+
+def _columns(data, specs: list[FieldSpec], labels: bool) -> dict:
+    import numpy as np
+    columns = {}
+    for spec in specs:
+        if spec.type is bytes:
+            values = np.ascontiguousarray(data[:, spec.offset:spec.offset + spec.size]).view(f"S{spec.size}")[:, 0]
+            columns[spec.path] = values
+            if labels:
+                columns[f"{spec.path}:text"] = np.char.decode(values, "latin-1")
+        else:
+            values = _column([spec], spec.path).func(data).astype(np.uint16 if spec.size == 2 else np.uint8)
+            columns[spec.path] = values
+            if labels and issubclass(spec.type, IntEnum):
+                # Values that aren't in the enum have no name.
+                names = np.array([""] * 256, dtype=object)
+                for member in spec.type:
+                    names[member] = member.name
+                columns[f"{spec.path}:name"] = names[values].astype(str)
+    return columns
+
+
+def _text_values(values) -> list:
+    if values.dtype.kind == "S":
+        return [value.ljust(values.dtype.itemsize, b"\x00").hex() for value in values.tolist()]
+    return values.tolist()
+
+
+def _write_npy(archive, name: str, values):
+    import numpy as np
+    with archive.open(f"{name}.npy", "w", force_zip64=True) as f:
+        np.lib.format.write_array(f, np.asarray(values), allow_pickle=False)
+
+
+def _write_joined_npy(archive, name: str, f, parts: list):
+    # parts are the (dtype, length) of each chunk in f. Text columns are widened to their longest value.
+    import numpy as np
+    dtype = np.result_type(*(part_dtype for part_dtype, _ in parts))
+    header = {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False,
+              "shape": (sum(length for _, length in parts),)}
+    with archive.open(f"{name}.npy", "w", force_zip64=True) as out:
+        np.lib.format.write_array_header_1_0(out, header)
+        for part_dtype, length in parts:
+            values = np.frombuffer(f.read(part_dtype.itemsize * length), dtype=part_dtype)
+            out.write(values.astype(dtype, copy=False).tobytes())
+
+
+def _rebuild(specs: list[FieldSpec], column, command_type) -> "PatchTable":
+    # column(name) gives the values of a column, or None if it's missing.
+    import numpy as np
+    data = None
+    for spec in specs:
+        values = column(spec.path)
+        if values is None and issubclass(spec.type, IntEnum) and column(f"{spec.path}:name") is not None:
+            values = [spec.type[name] for name in column(f"{spec.path}:name")]
+        if values is None:
+            raise ValueError(f"No values for {spec.path}")
+        if data is None:
+            data = np.zeros((len(values), get_codec(command_type).size), dtype=np.uint8)
+        if spec.type is bytes:
+            if len(values) and isinstance(values[0], str):
+                values = [bytes.fromhex(value) for value in values]
+            data[:, spec.offset:spec.offset + spec.size] = np.asarray(values, dtype=f"S{spec.size}").view(
+                np.uint8).reshape(-1, spec.size)
+            continue
+        values = np.asarray(values, dtype=np.int64)
+        if spec.mask:
+            values = (values << spec.shift) & spec.mask
+        for i in range(spec.size):
+            data[:, spec.offset + i] |= (values >> (8 * i)).astype(np.uint8)
+    _, invalid = check_many(data, command_type)
+    if invalid.any():
+        row = int(np.flatnonzero(invalid.any(axis=1))[0])
+        violations = check_bytes(bytes(data[row]), command_type)
+        raise ValueError(f"Patch {row} of the chunk is invalid: {ValidationError(violations)}")
+    return PatchTable(data, command_type)
+
+
+def _patch_chunks(source, command_type, chunk_size: int):
+    """The patches of an export_columns() source, as (n, size) arrays of up to chunk_size patches."""
+    import numpy as np
+    codec = get_codec(command_type)
+    if isinstance(source, (str, Path)):
+        if Path(source).is_dir():
+            source = (path.read_bytes() for path in sorted(Path(source).glob("*.syx")))
+        else:
+            with SyxBank(source, command_type) as bank:
+                yield from _patch_chunks(bank, command_type, chunk_size)
+            return
+    if isinstance(source, PatchTable):
+        for i in range(0, len(source), chunk_size):
+            yield source.data[i:i + chunk_size]
+    elif isinstance(source, SyxBank):
+        starts = np.frombuffer(source.starts, dtype=np.int64)
+        sizes = np.frombuffer(source.ends, dtype=np.int64) - starts
+        if (sizes != codec.size).any():
+            index = int(np.flatnonzero(sizes != codec.size)[0])
+            raise ValueError(f"Message {index} is {sizes[index]} bytes. Expected {codec.size}.")
+        buffer = np.frombuffer(source._buffer, dtype=np.uint8)
+        for i in range(0, len(starts), chunk_size):
+            yield buffer[starts[i:i + chunk_size, None] + np.arange(codec.size)]
+    else:
+        patches = iter(source)
+        while chunk := [patch for _, patch in zip(range(chunk_size), patches)]:
+            buffer = b"".join(codec.encode(patch) if isinstance(patch, PatchSysex) else bytes(patch) for patch in chunk)
+            if len(buffer) != codec.size * len(chunk):
+                raise ValueError(f"Expected patches of {codec.size} bytes.")
+            yield np.frombuffer(buffer, dtype=np.uint8).reshape(-1, codec.size)
+
+
+def morph(patches, steps: int, switch: float | dict[str, float] = 0.5,
+          command_type=ReplaceCurrentPatchCommand) -> PatchTable:
+    """
+    steps patches morphing through two or more patches, evenly spaced from the first to the last.
+    Numeric fields of the sound sections, such as levels, envelope times and rates, are interpolated.
+    Enum fields and the fields of bitfields switch from one patch to the next at a point of the way between them:
+    switch, or switch[key] for fields in a section or under a path given as a key, e.g. {"filter.type": 0.2}.
+    Other fields, such as the name and reserved fields, are the first patch's.
+
+    A patch may be a PatchSysex or encoded patch, or a PatchTable or (M, size) array to morph M sets at once,
+    giving M * steps patches, set by set. Write them with tobytes() as one .syx stream, or write_syx() as files.
+    Requires NumPy.
+    """
+    import numpy as np
+    codec = get_codec(command_type)
+    keys = [_patch_array(encode(patch) if isinstance(patch, PatchSysex) else patch, codec.size) for patch in patches]
+    if len(keys) < 2:
+        raise ValueError(f"Morphing needs two or more patches. (Given {len(keys)})")
+    # (patches, sets, size)
+    keys = np.stack(np.broadcast_arrays(*keys))
+    positions = np.linspace(0, len(keys) - 1, steps)
+    segments = np.minimum(positions.astype(np.intp), len(keys) - 2)
+    fractions = (positions - segments)[:, None, None]
+    start, end = keys[segments], keys[segments + 1]
+
+    data = np.broadcast_to(keys[0], start.shape).copy()
+    points = switch if isinstance(switch, dict) else {}
+    default = 0.5 if isinstance(switch, dict) else switch
+    continuous, switched = _morph_specs(command_type, default, tuple(sorted(points.items())))
+    start_values = start[..., continuous].astype(np.float32)
+    data[..., continuous] = np.rint(start_values + (end[..., continuous] - start_values) * fractions)
+    # The bits of each byte that have switched to the end patch
+    bits = np.zeros(data.shape, dtype=np.uint8)
+    for point, masks in switched.items():
+        bits |= (fractions >= point) * masks
+    offsets = np.flatnonzero(np.bitwise_or.reduce(list(switched.values())))
+    data[..., offsets] = start[..., offsets] & ~bits[..., offsets] | end[..., offsets] & bits[..., offsets]
+    return PatchTable(data.transpose(1, 0, 2), command_type)
+
+
+@cache
+def _morph_specs(command_type, default: float, points: tuple[tuple[str, float], ...]):
+    """The offsets of the interpolated fields, and the (size,) bit masks of the switched fields by switch point."""
+    import numpy as np
+    size = get_codec(command_type).size
+    continuous, switched = [], {}
+    for spec in _feature_specs(command_type):
+        if spec.mask or issubclass(spec.type, IntEnum):
+            point = _path_setting(spec.path, default, points)
+            masks = switched.setdefault(point, np.zeros(size, dtype=np.uint8))
+            masks[spec.offset] |= spec.mask or 0xff
+        else:
+            continuous.append(spec.offset)
+    return continuous, switched
+
+
+def _path_setting(path: str, default, settings: tuple[tuple[str, object], ...]):
+    """The setting of the longest key that is the path, or a section or path it's under."""
+    keys = [(len(key), setting) for key, setting in settings
+            if path == key or path.startswith((key + ".", key + "["))]
+    return max(keys)[1] if keys else default
+
+
+def mutate(population, rate: float | dict[str, float] = 0.05, amount: int = 16, rng=None,
+           command_type=ReplaceCurrentPatchCommand) -> PatchTable:
+    """
+    A randomly mutated copy of many patches, e.g. a PatchTable or (N, size) array, in one vectorized pass.
+    Each field of the sound sections is mutated with probability rate, or rate[key] for fields in a section
+    or under a path given as a key, e.g. {"mod_matrix": 0.2, "voice": 0}. Numeric fields move by up to amount
+    and stay 7-bit. Enum fields, and the fields of bitfields, get a random value they allow. So mutated patches
+    are valid if the originals are. rng is a numpy.random.Generator, or a seed. Requires NumPy.
+    """
+    import numpy as np
+    rng = np.random.default_rng(rng)
+    data = _patch_array(population, get_codec(command_type).size).copy()
+    points = rate if isinstance(rate, dict) else {}
+    default = 0.05 if isinstance(rate, dict) else rate
+    # Low rates draw a count of mutations and then their positions, so the cost is in proportion to the mutations.
+    # (A position drawn twice is mutated once, which is rare at low rates.)
+    # Fields sharing a byte are in different groups, so each group sees the bits the last one set.
+    for offsets, mask, shift, values, group_rate in _mutation_groups(command_type, default, tuple(sorted(points.items()))):
+        positions = len(data) * len(offsets)
+        if group_rate < 0.2:
+            mutated = rng.integers(positions, size=rng.binomial(positions, group_rate))
+        else:
+            mutated = np.flatnonzero(rng.random(positions, dtype=np.float32) < group_rate)
+        rows, columns = np.divmod(mutated, len(offsets))
+        columns = offsets[columns]
+        current = data[rows, columns]
+        if values is None:
+            steps = rng.integers(-amount, amount + 1, len(rows), dtype=np.int16)
+            data[rows, columns] = np.clip(current + steps, 0, 127)
+        else:
+            data[rows, columns] = current & ~mask | values[rng.integers(len(values), size=len(rows))] << shift
+    return PatchTable(data, command_type)
+
+
+def crossover(a, b, rng=None, command_type=ReplaceCurrentPatchCommand) -> PatchTable:
+    """
+    Children of pairs of patches, e.g. two PatchTables of the same length, taking each field of the sound sections
+    from either parent at random, and other fields from a. Bitfields are crossed over by field. Requires NumPy.
+    """
+    import numpy as np
+    rng = np.random.default_rng(rng)
+    size = get_codec(command_type).size
+    a, b = np.broadcast_arrays(_patch_array(a, size), _patch_array(b, size))
+    specs = _feature_specs(command_type)
+    # Whether each field of each child is taken from b, from random bits
+    from_b = np.unpackbits(rng.integers(0, 256, (len(a), (len(specs) + 7) // 8), dtype=np.uint8), axis=1, count=len(specs))
+    # The bits of each byte to take from b
+    bits = np.zeros(a.shape, dtype=np.uint8)
+    for mask, offsets, columns in _crossover_groups(command_type):
+        bits[:, offsets] |= from_b[:, columns] * mask
+    return PatchTable(a & ~bits | b & bits, command_type)
+
+
+def evolve(population, fitness, rate: float | dict[str, float] = 0.05, amount: int = 16, elite: int = 1,
+           tournament: int = 2, rng=None, command_type=ReplaceCurrentPatchCommand) -> PatchTable:
+    """
+    The next generation of a population of patches, given the fitness of each, higher being better.
+    The elite fittest patches are kept as they are. The rest are children of parents chosen by
+    tournaments of random patches, crossed over with crossover() and mutated with mutate(). Requires NumPy.
+
+        population = PatchTable.from_patches([patch] * 10000)
+        for _ in range(100):
+            population = evolve(population, score(population), rng=rng)
+    """
+    import numpy as np
+    rng = np.random.default_rng(rng)
+    data = _patch_array(population, get_codec(command_type).size)
+    fitness = np.asarray(fitness)
+    elite = min(elite, len(data))
+    children = len(data) - elite
+
+    def parents():
+        entrants = rng.integers(len(data), size=(children, tournament))
+        return data[entrants[np.arange(children), fitness[entrants].argmax(axis=1)]]
+
+    offspring = mutate(crossover(parents(), parents(), rng, command_type), rate, amount, rng, command_type)
+    fittest = data[np.argsort(fitness, kind="stable")[::-1][:elite]]
+    return PatchTable(np.concatenate([fittest, offspring.data]), command_type)
+
+
+@cache
+def _mutation_groups(command_type, default: float, points: tuple[tuple[str, float], ...]) -> list[tuple]:
+    """
+    The fields of the sound sections, grouped by their mutation rate and the values they allow,
+    as (offsets, mask, shift, values, rate). values is None for numeric fields.
+    """
+    import numpy as np
+    groups = {}
+    for spec in _feature_specs(command_type):
+        rate = _path_setting(spec.path, default, points)
+        if issubclass(spec.type, IntEnum):
+            values = tuple(spec.type)
+        elif spec.mask:
+            values = tuple(range((spec.mask >> spec.shift) + 1))
+        else:
+            values = None
+        groups.setdefault((spec.mask or 0xff, values, rate), []).append(spec.offset)
+    return [(np.array(offsets), np.uint8(mask), _lowest_bit(mask),
+             None if values is None else np.array(values, dtype=np.uint8), rate)
+            for (mask, values, rate), offsets in groups.items() if rate]
+
+
+@cache
+def _crossover_groups(command_type) -> list[tuple]:
+    """The fields of the sound sections, grouped by bit mask, as (mask, offsets, indices in _feature_specs())."""
+    import numpy as np
+    groups = {}
+    for i, spec in enumerate(_feature_specs(command_type)):
+        groups.setdefault(spec.mask or 0xff, []).append((spec.offset, i))
+    return [(np.uint8(mask), np.array([offset for offset, _ in fields]), np.array([i for _, i in fields]))
+            for mask, fields in groups.items()]
+
+
+def _feature_specs(command_type) -> list[FieldSpec]:
+    return [spec for spec in get_codec(command_type).index.values()
+            if _section(spec.path) in SOUND_SECTIONS
+            and not any(name.startswith("_") for name in spec.path.split("."))
+            and (spec.type is int or issubclass(spec.type, IntEnum))]
+
+
+def _section(path: str) -> str:
+    return path.split(".")[0].split("[")[0]
+
+
+@cache
+def _numpy_dtype(codec: Codec):
+    import numpy as np
+    formats = {"B": "u1", "1s": "u1", "<H": "<u2"}
+    return np.dtype(dict(
+        names=[spec.path for spec in codec.fields],
+        formats=[formats.get(spec.format, f"S{spec.size}") for spec in codec.fields],
+        offsets=[spec.offset for spec in codec.fields],
+        itemsize=codec.size))
+
+
+class _View:
+    """Reads and writes a dataclass's fields directly in the buffer of a PatchView."""
+    __slots__ = ("_root", "_offset")
+    # The codec of the viewed dataclass. Set on the generated view types.
+    _codec: Codec
+
+    def __init__(self, root: "PatchView", offset: int):
+        self._root = root
+        self._offset = offset
+
+    def decode(self):
+        """Copy the viewed fields into a new dataclass instance."""
+        return self._codec.decode(self._root.buffer, self._offset)
+
+    def __bytes__(self):
+        return bytes(self._root.buffer[self._offset:self._offset + self._codec.size])
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.decode()!r})"
+
+    def _assign(self, value):
+        data = bytes(value) if isinstance(value, _View) else self._codec.encode(value)
+        self._root._writable()[self._offset:self._offset + self._codec.size] = data
+
+
+class PatchView(_View):
+    """
+    A PatchSysex's fields, read and written directly in an encoded buffer,
+    e.g. a bytearray, memoryview, mmap or MIDI message. Nothing is decoded or copied
+    until a field is read. Writes need a writable buffer and change it in place.
+    command_type defaults to that of the patch's registered layout, as for decode().
+
+        view = PatchView(bytearray(Path("example.syx").read_bytes()))
+        view.meta.name = b"new name"
+        view.lfos[1].flags.key_sync = 1
+    """
+    __slots__ = ("buffer",)
+
+    def __new__(cls, buffer, offset: int = 0, command_type=None):
+        if command_type is None:
+            command_type = _command_type(buffer[offset:offset + 7])
+        return object.__new__(_view_type(PatchSysex, command_type, PatchView))
+
+    def __init__(self, buffer, offset: int = 0, command_type=None):
+        self.buffer = buffer
+        super().__init__(self, offset)
+
+    def _writable(self):
+        """The buffer, for writing a field."""
+        return self.buffer
+
+
+class PatchClone(PatchView):
+    """
+    A copy-on-write PatchView of a template patch, which shares the template's bytes until a field is written,
+    and then writes to its own copy. Make them with clone(). Cloning a clone that hasn't been written
+    shares the same bytes, so fanning a template out into many variants costs about one small buffer each.
+
+        template = clone(read_syx("example.syx"))
+        variants = [clone(template) for _ in range(1000)]
+        variants[0].filter.frequency = 64  # Copies 350 bytes; the rest still share the template's
+    """
+    __slots__ = ("_shared",)
+
+    def __new__(cls, buffer: bytes, command_type=None):
+        if command_type is None:
+            command_type = _command_type(buffer)
+        return object.__new__(_view_type(PatchSysex, command_type, PatchClone))
+
+    def __init__(self, buffer: bytes, command_type=None):
+        super().__init__(buffer, 0, command_type)
+        self._shared = True
+
+    def _writable(self):
+        if self._shared:
+            self.buffer = bytearray(self.buffer)
+            self._shared = False
+        return self.buffer
+
+
+def clone(template) -> PatchClone:
+    """
+    A copy-on-write PatchClone of a PatchSysex, an encoded patch, or a PatchView.
+    Bytes and unwritten clones are shared; other templates are encoded or copied once per call.
+    """
+    if isinstance(template, PatchClone) and template._shared:
+        return PatchClone(template.buffer, template._codec.command_type)
+    if isinstance(template, PatchSysex):
+        return PatchClone(encode(template), type(template.command))
+    buffer = bytes(template)
+    return PatchClone(buffer, _command_type(buffer))
+
+
+class _ListView(Sequence):
+    __slots__ = ("_item_type", "_root", "_offset", "_length")
+
+    def __init__(self, item_type, root: PatchView, offset: int, length: int):
+        self._item_type = item_type
+        self._root = root
+        self._offset = offset
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("list index out of range")
+        return self._item_type(self._root, self._offset + index * self._item_type._codec.size)
+
+    def __setitem__(self, index: int, value):
+        self[index]._assign(value)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class _BitfieldView:
+    """Reads and writes a ctypes bitfield Structure's fields directly in the buffer of a PatchView."""
+    __slots__ = ("_root", "_offset")
+    # The viewed ctypes Structure type. Set on the generated view types.
+    _type: type
+
+    def __init__(self, root: PatchView, offset: int):
+        self._root = root
+        self._offset = offset
+
+    def copy(self):
+        return self._type.from_buffer_copy(bytes(self))
+
+    def __bytes__(self):
+        return bytes(self._root.buffer[self._offset:self._offset + _sizeof(self._type)])
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+@cache
+def _view_type(field_type, command_type, base=_View) -> type:
+    codec = get_codec(command_type) if field_type is PatchSysex else Codec(field_type, command_type)
+    namespace = dict(__slots__=(), _codec=codec)
+    offset = 0
+    for f in fields(field_type):
+        namespace[f.name] = _view_property(f.type, f.metadata, command_type, offset)
+        offset += struct.calcsize("<" + _compile(f.type, f.metadata, command_type).format)
+    # Keep properties such as Meta.name, which work through the viewed fields.
+    namespace.update((name, attr) for name, attr in vars(field_type).items() if isinstance(attr, property))
+    return type(f"{field_type.__name__}View", (base,), namespace)
+
+
+def _view_property(field_type, metadata, command_type, offset: int) -> property:
+    if "list_len" in metadata:
+        item_type = _view_type(field_type.__args__[0], command_type)
+        length = metadata["list_len"]
+
+        def get(self):
+            return _ListView(item_type, self._root, self._offset + offset, length)
+
+        def set(self, values):
+            items = get(self)
+            if len(values) != length:
+                raise ValueError(f"Expected {length} items. (Given {len(values)})")
+            for i, value in enumerate(values):
+                items[i] = value
+    elif "read_type" in metadata:
+        return _view_property(command_type or metadata["read_type"], {}, command_type, offset)
+    elif is_dataclass(field_type):
+        view_type = _view_type(field_type, command_type)
+
+        def get(self):
+            return view_type(self._root, self._offset + offset)
+
+        def set(self, value):
+            get(self)._assign(value)
+    elif "bitfield" in metadata:
+        view_type = _bitfield_view_type(field_type)
+        size = _sizeof(field_type)
+
+        def get(self):
+            return view_type(self._root, self._offset + offset)
+
+        def set(self, value):
+            start = self._offset + offset
+            self._root._writable()[start:start + size] = bytes(value)
+    elif "format" in metadata:
+        packer = struct.Struct(metadata["format"])
+
+        def get(self):
+            return field_type(*packer.unpack_from(self._root.buffer, self._offset + offset))
+
+        def set(self, value):
+            start = self._offset + offset
+            self._root._writable()[start:start + packer.size] = packer.pack(value)
+    else:
+        def get(self):
+            return field_type(self._root.buffer[self._offset + offset])
+
+        def set(self, value):
+            self._root._writable()[self._offset + offset] = value
+    return property(get, set)
+
+
+@cache
+def _bitfield_view_type(bitfield_type) -> type:
+    size = _sizeof(bitfield_type)
+    namespace = dict(__slots__=(), _type=bitfield_type)
+    for name, mask in _bitfield_masks(bitfield_type).items():
+        namespace[name] = _bitfield_property(size, mask)
+    return type(f"{bitfield_type.__name__}View", (_BitfieldView,), namespace)
+
+
+def _bitfield_property(size: int, mask: int) -> property:
+    shift = _lowest_bit(mask)
+
+    def get(self):
+        start = self._offset
+        return (int.from_bytes(self._root.buffer[start:start + size], "little") & mask) >> shift
+
+    def set(self, value):
+        start = self._offset
+        buffer = self._root._writable()
+        bits = int.from_bytes(buffer[start:start + size], "little") & ~mask | (value << shift) & mask
+        buffer[start:start + size] = bits.to_bytes(size, "little")
+    return property(get, set)
+
+
+def _lowest_bit(mask: int) -> int:
+    return (mask & -mask).bit_length() - 1
+
+
+@cache
+def _bitfield_masks(bitfield_type) -> dict[str, int]:
+    """The bits of each field of a ctypes bitfield Structure, as integers read little-endian from its bytes."""
+    masks = {}
+    for name, _, bits in bitfield_type._fields_:
+        flags = bitfield_type()
+        setattr(flags, name, (1 << bits) - 1)
+        masks[name] = int.from_bytes(bytes(flags), "little")
+    return masks
+
+
+def main(argv: list[str] | None = None) -> int:
+    """
+    The command line tool, run as python -m ctpatch. Returns the exit status.
+
+    Files may be given as globs, or listed one per line on stdin when none (or "-") are given.
+    They are processed across a pool of processes, and output is printed as each batch of files is done.
+    """
+    import argparse
+    import sys
+
+    jobs = argparse.ArgumentParser(add_help=False)
+    jobs.add_argument("-j", "--jobs", type=int, help="number of worker processes (default: one per CPU)")
+    parser = argparse.ArgumentParser(prog="python -m ctpatch",
+                                     description="Get, set, dump, validate and rename many .syx patch files at once.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    get_command = commands.add_parser("get", parents=[jobs], help="print a field of each patch")
+    get_command.add_argument("path", help="a field path, e.g. filter.frequency or lfos[1].flags.key_sync")
+    set_command = commands.add_parser("set", parents=[jobs], help="set a field of each patch, in place")
+    set_command.add_argument("assignment", help="PATH=VALUE, e.g. filter.frequency=64 or filter.type=LOW_PASS_12DB")
+    dump_command = commands.add_parser("dump", parents=[jobs], help="print each patch")
+    dump_command.add_argument("--json", action="store_true", help="print JSON lines, rather than Python reprs")
+    validate_command = commands.add_parser("validate", parents=[jobs], help="print the rules each patch breaks")
+    validate_command.add_argument("--strict", action="store_true", help="see check()")
+    rename_command = commands.add_parser("rename", parents=[jobs], help="set the name of each patch, in place")
+    rename_command.add_argument("name", help="the new name, which may include the file's {stem} and the patch's {name}")
+    for command in get_command, set_command, dump_command, validate_command, rename_command:
+        command.add_argument("files", nargs="*", help="files or globs, or '-' (the default) to read file names from stdin")
+    args = parser.parse_args(argv)
+
+    if args.command == "get":
+        _cli_check_path(parser, args.path)
+        task = ("get", args.path)
+    elif args.command == "set":
+        path, equals, value = args.assignment.partition("=")
+        if not equals:
+            parser.error(f"Expected PATH=VALUE. (Given {args.assignment!r})")
+        _cli_check_path(parser, path)
+        task = ("set", path, value)
+    elif args.command == "dump":
+        task = ("dump", args.json)
+    elif args.command == "validate":
+        task = ("validate", args.strict)
+    else:
+        task = ("rename", args.name)
+
+    names = args.files if args.files and args.files != ["-"] else (line.strip() for line in sys.stdin)
+    paths = []
+    for name in filter(None, names):
+        if any(c in name for c in "*?["):
+            import glob
+            paths += sorted(glob.glob(name, recursive=True))
+        else:
+            paths.append(name)
+
+    status = 0
+    try:
+        for out, errors, failed in _cli_map(task, paths, args.jobs):
+            for line in out:
+                print(line)
+            for line in errors:
+                print(line, file=sys.stderr)
+            sys.stdout.flush()
+            status = status or int(failed)
+    except BrokenPipeError:
+        # The reader went away, e.g. head. Stop quietly, pointing stdout at devnull so that its flush at exit can't fail.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    return status
+
+
+def _cli_check_path(parser, path: str):
+    if path not in get_codec().index:
+        parser.error(f"No field {path!r}. See ctpatch.field_index() for the field paths.")
+
+
+def _cli_map(task: tuple, paths: list[str], jobs: int | None, chunksize: int = 16):
+    chunks = [paths[i:i + chunksize] for i in range(0, len(paths), chunksize)]
+    if jobs == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            yield _cli_chunk(task, chunk)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+    with ProcessPoolExecutor(jobs) as executor:
+        yield from executor.map(partial(_cli_chunk, task), chunks)
+
+
+def _cli_chunk(task: tuple, paths: list[str]) -> tuple[list[str], list[str], bool]:
+    """Run a task of main() on some files. Returns the lines to print, the errors, and whether any file failed."""
+    out, errors, failed = [], [], False
+    for path in paths:
+        try:
+            buffer = bytearray(Path(path).read_bytes())
+            command_type = _command_type(buffer)
+            if task[0] == "get":
+                out.append(f"{path}\t{_cli_format(get_field(buffer, task[1], command_type))}")
+            elif task[0] == "set":
+                spec = get_codec(command_type).index[task[1]]
+                set_field(buffer, task[1], _cli_parse(spec, task[2]), command_type)
+                _cli_write(path, buffer, command_type)
+            elif task[0] == "dump":
+                patch = get_codec(command_type).decode(buffer)
+                if task[1]:
+                    import json
+                    out.append(json.dumps({"path": path, "patch": _json_value(patch)}))
+                else:
+                    from pprint import pformat
+                    out.append(f"# {path}\n{pformat(patch)}")
+            elif task[0] == "validate":
+                for v in check_bytes(buffer, command_type, strict=task[1]):
+                    out.append(f"{path}: {v.path or 'patch'} {v.message} (Given {v.value!r})")
+                    failed = True
+            elif task[0] == "rename":
+                old_name = get_field(buffer, "meta._name", command_type).decode("latin-1").rstrip()
+                name = task[1].format(stem=Path(path).stem, name=old_name)
+                meta = Meta(b"")
+                meta.name = name.encode("ascii")
+                set_field(buffer, "meta._name", meta.name, command_type)
+                _cli_write(path, buffer, command_type)
+        except Exception as e:
+            errors.append(f"{path}: {e}")
+            failed = True
+    return out, errors, failed
+
+
+def _cli_parse(spec: FieldSpec, text: str):
+    """A field value from the command line: an enum name or number, an integer, or text for bytes fields."""
+    if spec.type is bytes:
+        return text.encode("latin-1")
+    if issubclass(spec.type, IntEnum) and not text.lstrip("-").isdigit():
+        return spec.type[text.upper()]
+    return int(text, 0)
+
+
+def _cli_format(value) -> str:
+    value = _json_value(value)
+    return value if isinstance(value, str) else repr(value)
+
+
+def _cli_write(path: str, buffer, command_type):
+    violations = check_bytes(buffer, command_type)
+    if violations:
+        raise ValidationError(violations)
+    _replace_file(path, buffer)
+
+
+def _json_value(obj):
+    """A patch, or one of its fields, as JSON-serializable values. Enums become names, and bytes latin-1 text."""
+    if is_dataclass(obj):
+        return {f.name: _json_value(getattr(obj, f.name)) for f in fields(obj)}
+    elif isinstance(obj, list):
+        return [_json_value(item) for item in obj]
+    elif isinstance(obj, IntEnum):
+        return obj.name
+    elif isinstance(obj, bytes):
+        return obj.decode("latin-1")
+    elif isinstance(obj, Structure):
+        return {name: getattr(obj, name) for name, *_ in obj._fields_}
+    return obj
+
+
+if __name__ == "__main__":
+    # Run the imported module, rather than this __main__ one, so that worker processes and pickled values see the same types.
+    import sys
+    import ctpatch
+    sys.exit(ctpatch.main())
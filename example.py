@@ -1,4 +1,4 @@
-import time
+import asyncio
 import ctpatch
 
 """
@@ -7,18 +7,23 @@ Read example.syx and generate programmatically modified versions of it.
 """
 
 patch = ctpatch.read_syx("example.syx")
+# Variants share the template's bytes until they're changed.
+template = ctpatch.clone(patch)
 
 # Save a modified version of the input patch for every filter type.
+filenames, variants = [], []
 for type in ctpatch.FilterType:
     name = type.name
+    variant = ctpatch.clone(template)
     # Set the patch values...
     # Patch name is the filter type (converted to bytes)
-    patch.meta.name = name.encode("utf8")
-    patch.filter.type = type
-    # Write the file
-    filename = f"generated {name}.syx"
-    print(f"Saving patch '{filename}'...")
-    ctpatch.write_syx(filename, patch)
+    variant.meta.name = name.encode("utf8")
+    variant.filter.type = type
+    filenames.append(f"generated {name}.syx")
+    variants.append(variant)
+# Write the files in one batch
+result = ctpatch.write_many(filenames, variants)
+print(f"Saved {result.files} patches at {result.files_per_second:.0f} files/s")
 
 
 """
@@ -52,13 +57,8 @@ if upload_patches:
     out_index = next(i for i, name in enumerate(midiout.get_ports()) if "Circuit Tracks" in name)
     midiout.open_port(out_index)
 
-    for slot, name in patch_slot_file_names:
-        patch = ctpatch.read_syx(name)
-        # To write a patch, the sysex command must be set to a ReplacePatchCommand
-        patch.command = ctpatch.ReplacePatchCommand(pack_index=pack_index, patch_index=slot)
-
-        sysex_bytes = ctpatch.encode(patch)
-        print(f"Sending '{name}' to MIDI output {out_index} ...")
-        midiout.send_message(sysex_bytes)
-        # Let CT catch up...
-        time.sleep(0.1)
+    # To write a patch, the sysex command must be a ReplacePatchCommand. upload() sets that for each slot,
+    # and paces sending to let CT catch up.
+    items = [(pack_index, slot, ctpatch.read_syx(name)) for slot, name in patch_slot_file_names]
+    print(f"Sending {len(items)} patches to MIDI output {out_index} ...")
+    asyncio.run(ctpatch.upload(items, ctpatch.RtMidiTransport(midiout)))
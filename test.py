@@ -1,10 +1,32 @@
 
+import asyncio
 import difflib
+import io
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+from contextlib import redirect_stdout
+from dataclasses import replace
+from pathlib import Path
 from pprint import pformat
-from ctpatch import (DistortionType, Envelope, Filter, FilterType, Footer, Fx, Header, Lfo, LfoFadeMode,
-                     LfoFlags, LfoWaveform, MacroKnob, MacroKnobDestination, MacroKnobRange, Mixer,
-                     ModMatrix, ModMatrixDestination, ModMatrixSource, Osc, OscWaveform, Meta, PatchSysex,
-                     PolyphonyMode, ReplaceCurrentPatchCommand, Voice, read_syx, write_syx)
+from ctpatch import (DistortionType, DuplicateIndex, Envelope, FakeDevice, Filter, FilterType, Footer, Fx, Header, Lfo,
+                     LfoFadeMode, LfoFlags, LfoWaveform, LoopbackTransport, MacroKnob, MacroKnobDestination, MacroKnobRange,
+                     Mixer, ModMatrix, ModMatrixDestination, ModMatrixSource, Osc, OscWaveform, Meta, PatchPack, PatchSysex,
+                     PatchView, PolyphonyMode, ReplaceCurrentPatchCommand, ReplacePatchCommand, Stats, SysexCommand, SyxBank,
+                     SyxCache, ValidationError, Voice, apply, backup, check, check_bytes, clone, decode, decode_reference,
+                     encode, encode_reference, get_field, get_stats, iter_syx, main, read_syx, register_layout, set_field,
+                     sound_hash, upload, validate, write_bank, write_many, write_syx)
+from ctpatch import diff as patch_diff
+
+try:
+    import numpy
+    from ctpatch import (PatchTable, Query, SimilarityIndex, check_many, crossover, diff_many, evolve, export_columns,
+                         import_columns, morph, mutate, select)
+except ImportError:
+    numpy = None
 
 
 test_patch = PatchSysex(
@@ -333,6 +355,351 @@ d = difflib.unified_diff(pformat(p).splitlines(), pformat(test_patch).splitlines
 diff = "\n".join(d)
 assert not diff, diff
 
+# The compiled codec must match the recursive reference implementation.
+buffer = encode(test_patch)
+assert buffer == encode_reference(test_patch)
+assert pformat(decode(buffer)) == pformat(decode_reference(buffer)) == pformat(test_patch)
+bad_filter = bytearray(buffer)
+set_field(bad_filter, "filter.type", 9)
+try:
+    decode(bad_filter)
+    assert False
+except ValueError as e:
+    assert str(e) == "9 is not a valid FilterType (filter.type)"
+test_patch.command = ReplacePatchCommand(pack_index=3, patch_index=9)
+assert encode(test_patch) == encode_reference(test_patch)
+test_patch.command = ReplaceCurrentPatchCommand(command_id=0, location=4, _reserved=5)
+
+# A bank file is any number of concatenated sysex messages.
+example = read_syx("example.syx")
+with open("test_bank.syx", "wb") as f:
+    f.write(encode(example) * 3)
+with SyxBank("test_bank.syx") as bank:
+    assert len(bank) == 3
+    assert pformat(bank[2]) == pformat(example)
+
+# Patches decode with the layout registered for their product number and command.
+slot_patch = encode(replace(example, command=ReplacePatchCommand(pack_index=1, patch_index=5)))
+with open("test_bank.syx", "wb") as f:
+    f.write(encode(example) + slot_patch)
+with SyxBank("test_bank.syx") as bank:
+    assert [type(patch.command) for patch in bank] == [ReplaceCurrentPatchCommand, ReplacePatchCommand]
+assert decode(slot_patch).command.patch_index == 5
+assert PatchView(slot_patch).meta.name == example.meta.name and PatchView(b"\0" + slot_patch, 1).command.patch_index == 5
+with open("test_slot.syx", "wb") as f:
+    f.write(slot_patch)
+write_syx("test_slot.syx", read_syx("test_slot.syx"))
+other_device = bytearray(encode(example))
+other_device[5] = 0x65
+assert check_bytes(other_device)[0].path == "header.prod_num"
+register_layout(0x65, SysexCommand.REPLACE_CURRENT_PATCH, ReplaceCurrentPatchCommand)
+assert check_bytes(other_device) == [] and decode(other_device).header.prod_num == 0x65
+
+# Reading many files collects the errors of those that fail.
+invalid = bytearray(encode(example))
+invalid[20] = 0x80  # In meta._name
+with open("test_invalid.syx", "wb") as f:
+    f.write(invalid)
+results = list(iter_syx(["example.syx", "test.py", "test_patch.syx", "test_invalid.syx"], workers=2))
+assert [r.ok for r in results] == [True, False, True, False]
+assert isinstance(results[1].error, ValueError)
+assert pformat(results[2].patch) == pformat(test_patch)
+assert [v.path for v in results[3].error.violations] == ["meta._name"]
+
+# The cache only rereads files that have changed.
+if os.path.exists("test_cache.db"):
+    os.remove("test_cache.db")
+with SyxCache("test_cache.db") as cache:
+    assert pformat(cache.read_syx("test_patch.syx")) == pformat(test_patch)
+    assert pformat(cache.read_syx("test_patch.syx")) == pformat(test_patch)
+    assert cache.read_meta("test_patch.syx").name == test_patch.meta.name
+    assert (cache.hits, cache.misses) == (2, 1)
+
+# Uploads are sent as ReplacePatchCommands to the given slots.
+transport = LoopbackTransport()
+assert asyncio.run(upload([(1, 8, example), (1, 9, example)], transport, bytes_per_second=1e6)) == 2
+sent = [message for _, message in transport.sent]
+assert [get_field(m, "command.patch_index", ReplacePatchCommand) for m in sent] == [8, 9]
+assert example.command == ReplaceCurrentPatchCommand()
+assert asyncio.run(upload([(1, 10, clone(example))], transport, bytes_per_second=None)) == 1
+assert decode(transport.sent[-1][1]).command == ReplacePatchCommand(pack_index=1, patch_index=10)
+try:
+    asyncio.run(upload([(1, 8, example), (1, 9, replace(example, oscillators=example.oscillators[:1]))], transport))
+    assert False
+except struct.error:
+    assert len(transport.sent) == 4
+
+# Backups match dump replies to their requests, and retry unanswered requests.
+os.makedirs("test_device", exist_ok=True)
+write_syx("test_device/0.syx", example)
+write_syx("test_device/1.syx", test_patch)
+
+
+async def run_backup():
+    device = FakeDevice("test_device", drop_every=2)
+    results = backup([0, 1, 2], device, "test_backup", concurrency=1, timeout=0.05, retries=1)
+    return {result.location: result async for result in results}
+results = asyncio.run(run_backup())
+assert pformat(results[1].patch.oscillators) == pformat(read_syx("test_backup/001.syx").oscillators)
+assert results[0].ok and not results[2].ok
+
+# Packs only sync the slots that changed.
+# (test_patch's header doesn't start a sysex message, so it can't be found in a multi-message file.)
+pack = PatchPack(2, {0: read_syx("example.syx"), 1: replace(read_syx("test_patch.syx"), header=Header())})
+pack.write("test_pack.syx")
+pack = PatchPack.read("test_pack.syx")
+assert pack.pack_index == 2 and pformat(pack.slots[1].lfos) == pformat(test_patch.lfos)
+shutil.rmtree("test_pack", ignore_errors=True)
+assert pack.sync_dir("test_pack") == [0, 1]
+pack.slots[1].filter.frequency = 1
+assert pack.sync_dir("test_pack") == [1]
+transport = LoopbackTransport()
+assert asyncio.run(pack.upload(transport, bytes_per_second=None)) == [0, 1]
+pack.slots[0].meta.name = b"Changed"
+assert asyncio.run(pack.upload(transport, bytes_per_second=None)) == [0]
+pack.slots[2] = clone(example)
+pack.write("test_pack.syx")
+assert PatchPack.read("test_pack.syx").slots[2].command.patch_index == 2 and pack.sync_dir("test_pack") == [0, 2]
+assert asyncio.run(pack.upload(transport, bytes_per_second=None)) == [2]
+assert encode(read_syx("test_pack/02.syx")) == encode(example)
+pack.slots[0].meta.category = 0x80
+try:
+    pack.write("test_pack.syx")
+    assert False
+except ValueError as e:
+    assert "meta.category" in str(e) and len(PatchPack.read("test_pack.syx").slots) == 3
+
+# Bulk writes validate every patch before writing any file.
+os.makedirs("test_many", exist_ok=True)
+result = write_many([f"test_many/{i}.syx" for i in range(3)], [example, encode(test_patch), example], workers=2, fsync="dir")
+assert (result.files, result.bytes) == (3, 3 * 350) and read_syx("test_many/1.syx").meta == test_patch.meta
+assert write_bank("test_bank.syx", [example] * 3, fsync="file").bytes == 3 * 350
+try:
+    write_many(["test_many/3.syx", "test_many/4.syx"], [example, encode(example)[:20] + b"\x80" + encode(example)[21:]])
+    assert False
+except ValueError as e:
+    assert str(e).startswith("Patch 1 is invalid") and not os.path.exists("test_many/3.syx")
+os.makedirs("test_many/dir.syx", exist_ok=True)
+try:
+    write_many(["test_many/dir.syx"], [example])
+    assert False
+except OSError:
+    assert not [name for name in os.listdir("test_many") if name.endswith(".tmp")]
+if os.name == "posix":
+    umask = os.umask(0o077)
+    try:
+        write_many(["test_many/private.syx"], [example])
+    finally:
+        os.umask(umask)
+    assert os.stat("test_many/private.syx").st_mode & 0o777 == 0o600
+
+# The duplicate index hashes patches of either command, and skips files of no registered layout.
+write_many(["test_many/slot.syx", "test_many/short.syx"], [slot_patch, example], fsync="none")
+with open("test_many/short.syx", "r+b") as f:
+    f.truncate(100)
+with DuplicateIndex(":memory:") as index:
+    assert index.add_files(["test_many/0.syx", "test_many/slot.syx", "test_many/short.syx"]) == [Path("test_many/short.syx")]
+    assert [[os.path.basename(path) for path in group] for group in index.duplicates()] == [["0.syx", "slot.syx"]]
+
+# Views read and write the encoded bytes in place.
+buffer = bytearray(encode(test_patch))
+view = PatchView(buffer)
+assert view.filter.type == FilterType.BAND_PASS_12DB
+assert view.lfos[0].flags.common_sync and not view.lfos[0].flags.key_sync
+view.meta.name = b"Viewed"
+view.lfos[0].flags.fade_mode = LfoFadeMode.GATE_OUT
+view.oscillators[1] = test_patch.oscillators[0]
+viewed = decode(buffer)
+assert viewed.meta.name == b"Viewed          "
+assert viewed.lfos[0].flags.fade_mode == LfoFadeMode.GATE_OUT and viewed.lfos[0].flags.one_shot
+assert viewed.oscillators[1] == test_patch.oscillators[0]
+
+set_field(buffer, "lfos[1].flags.delay_trigger", 0)
+set_field(buffer, "macro_knobs[3].ranges[2].depth", 99)
+assert get_field(buffer, "lfos[1].flags.key_sync") == 1
+assert get_field(buffer, "macro_knobs[3].ranges[2].end_pos") == 25
+assert get_field(buffer, "macro_knobs[3].ranges[2].destination") == MacroKnobDestination.O2_DENSITY_DETUNE
+viewed = decode(buffer)
+assert not viewed.lfos[1].flags.delay_trigger and viewed.lfos[1].flags.fade_mode == LfoFadeMode.GATE_IN
+assert viewed.macro_knobs[3].ranges[2].depth == 99
+
+# Clones share their template's bytes until they're written.
+template = clone(example)
+variants = [clone(template) for _ in range(3)]
+variants[1].filter.type = FilterType.HIGH_PASS_12DB
+variants[2].lfos[1].flags.key_sync = 1
+assert variants[0].buffer is template.buffer and variants[1].buffer is not template.buffer
+assert template.filter.type == FilterType.LOW_PASS_24DB
+assert decode(encode(variants[1])).filter.type == FilterType.HIGH_PASS_12DB
+assert patch_diff(encode(template), encode(variants[2]))[0].path == "lfos[1].flags.key_sync"
+write_syx("test_clone.syx", variants[1])
+assert read_syx("test_clone.syx").filter.type == FilterType.HIGH_PASS_12DB and check(variants[1]) == []
+
+# Sounds that differ only in name, command or product number hash the same.
+renamed = bytearray(buffer)
+set_field(renamed, "meta._name", b"Renamed")
+set_field(renamed, "header.prod_num", 0x60)
+assert sound_hash(renamed) == sound_hash(buffer)
+set_field(renamed, "fx.chorus_level", 1)
+assert sound_hash(renamed) != sound_hash(buffer)
+
+# Deltas name the fields that changed, and reapply them.
+delta = patch_diff(encode(test_patch), buffer)
+paths = [change.path for change in delta]
+assert len(paths) == 13 and paths[:2] == ["meta._name", "oscillators[1].wave"]
+assert paths[-3:] == ["lfos[0].flags.fade_mode", "lfos[1].flags.delay_trigger", "macro_knobs[3].ranges[2].depth"]
+assert apply(bytearray(encode(test_patch)), delta) == buffer
+
+# Validation reports every violation, by path.
+invalid = bytearray(encode(example))
+set_field(invalid, "filter.type", 6)
+set_field(invalid, "mod_matrix[3].source1", 2)
+set_field(invalid, "meta.category", 0x80)
+assert [(v.path, v.value) for v in check_bytes(invalid)] == [
+    ("meta.category", 0x80), ("filter.type", 6), ("mod_matrix[3].source1", 2)]
+fade = bytearray(encode(example))
+set_field(fade, "lfos[0].flags.fade_mode", 7)
+assert [(v.path, v.value) for v in check_bytes(fade)] == [("lfos[0].flags.fade_mode", 7)]
+assert check_bytes(encode(example), strict=True) == []
+assert [v.path for v in check_bytes(encode(test_patch), strict=True)] == [
+    "header.sysex", "command._reserved", "meta._reserved", "fx._fx_reserved1", "fx._fx_reserved2", "fx._fx_reserved3",
+    "fx._fx_reserved45678"]
+try:
+    validate(replace(example, envelopes=example.envelopes[:2]))
+    assert False
+except ValidationError as e:
+    assert e.violations[0].path == "envelopes"
+
+# The command line tool works on the encoded files in place.
+shutil.copy("example.syx", "test_cli.syx")
+assert main(["set", "-j", "1", "filter.type=low_pass_24db", "test_cli.syx"]) == 0
+assert main(["rename", "-j", "1", "CLI {name}", "test_cli.syx"]) == 0
+output = io.StringIO()
+with redirect_stdout(output):
+    assert main(["get", "-j", "1", "filter.type", "test_cli.syx"]) == 0
+    assert main(["validate", "-j", "1", "--strict", "test_cli.syx", "test_patch.syx"]) == 1
+lines = output.getvalue().splitlines()
+assert lines[0] == "test_cli.syx\tLOW_PASS_24DB" and lines[1] == "test_patch.syx: header.sysex should be 0xf0 (Given 0)"
+assert read_syx("test_cli.syx").meta.name == b"CLI saw dst     "
+with open("test_cli_slot.syx", "wb") as f:
+    f.write(slot_patch)
+assert main(["rename", "-j", "1", "{name}!", "test_cli_slot.syx"]) == 0
+assert read_syx("test_cli_slot.syx").meta.name == b"saw dst!        "
+if os.name == "posix":
+    # In-place edits write through symlinks, and keep the file's permissions.
+    os.chmod("test_cli.syx", 0o600)
+    if os.path.lexists("test_cli_link.syx"):
+        os.remove("test_cli_link.syx")
+    os.symlink("test_cli.syx", "test_cli_link.syx")
+    assert main(["rename", "-j", "1", "Linked", "test_cli_link.syx"]) == 0
+    assert os.path.islink("test_cli_link.syx") and read_syx("test_cli.syx").meta.name == b"Linked          "
+    assert os.stat("test_cli.syx").st_mode & 0o777 == 0o600
+    # Output to a reader that stops early ends quietly.
+    head = subprocess.run(f"{sys.executable} -m ctpatch get -j 1 filter.type | head -1", shell=True,
+                          input="example.syx\n" * 20000, capture_output=True, text=True)
+    assert head.stdout == "example.syx\tLOW_PASS_24DB\n" and "Error" not in head.stderr
+
+# Stats count and time the instrumented operations while enabled.
+timings = []
+with Stats() as stats:
+    stats.callbacks.append(lambda name, seconds: timings.append(name))
+    write_syx("test_patch.syx", read_syx("test_patch.syx"))
+snapshot = stats.snapshot()
+assert snapshot["read_syx"]["count"] == snapshot["write_syx"]["count"] == snapshot["file_read"]["count"] == 1
+assert snapshot["decode.mod_matrix"]["count"] == 1 and snapshot["encode"]["count"] == 1
+assert timings[-1] == "write_syx" and "validate" in timings
+assert get_stats() is None
+
+if numpy:
+    table = PatchTable.from_patches([test_patch, p])
+    assert table.tobytes() == encode(test_patch) * 2
+    assert list(table["oscillators[1].wave"]) == [OscWaveform.DIGITAL_NASTY_1] * 2
+    table["mixer.post_fx_level"] = [1, 2]
+    assert table.patch(1).mixer.post_fx_level == 2
+    assert list(table["lfos[1].flags.key_sync"]) == [1, 1]
+    table["lfos[1].flags.fade_mode"] = [LfoFadeMode.FADE_IN, LfoFadeMode.GATE_OUT]
+    assert table.patch(1).lfos[1].flags.fade_mode == LfoFadeMode.GATE_OUT and table.patch(1).lfos[1].flags.key_sync
+
+    diff_paths, changed = diff_many(encode(test_patch), numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(1, -1))
+    assert [path for path, c in zip(diff_paths, changed[0]) if c] == [change.path for change in delta]
+
+    field_paths, invalid_fields = check_many(numpy.frombuffer(encode(example) + invalid, dtype=numpy.uint8).reshape(2, -1))
+    assert list(invalid_fields.any(axis=1)) == [False, True]
+    assert [path for path, i in zip(field_paths, invalid_fields[1]) if i] == [v.path for v in check_bytes(invalid)]
+    field_paths, invalid_fields = check_many(numpy.frombuffer(fade, dtype=numpy.uint8).reshape(1, -1))
+    assert [path for path, i in zip(field_paths, invalid_fields[0]) if i] == ["lfos[0].flags.fade_mode"]
+
+    # Bulk writes of tables and arrays check every row in one pass.
+    bank = PatchTable.from_patches([example] * 4)
+    assert write_bank("test_table.syx", bank).bytes == write_bank("test_table.syx", bank.data).bytes == 4 * 350
+    bank.data[2] = numpy.frombuffer(fade, dtype=numpy.uint8)
+    try:
+        write_bank("test_table.syx", bank)
+        assert False
+    except ValueError as e:
+        assert str(e).startswith("Patch 2 is invalid: lfos[0].flags.fade_mode")
+
+    query = "filter.type == LOW_PASS_24DB and any(mod_matrix.source1 == LFO_1_PLUS) and meta.name == 'saw dst'"
+    assert list(select(query, PatchTable.from_patches([test_patch, example]))) == [1]
+    assert list(select("not (oscillators[1].wave == DIGITAL_NASTY_1 or meta.name != 'saw dst')", "test_bank.syx")) == [0, 1, 2]
+    matches = select("any(macro_knobs.ranges.depth > 100) and abs(filter.frequency - 40) < 5", "test_device")
+    assert [path.name for path in matches] == ["0.syx"]
+    try:
+        Query("mod_matrix.destination == FILTER_FREQUENCY")
+        assert False
+    except ValueError as e:
+        assert "any() or all()" in str(e)
+    assert isinstance(Query(query), Query) and Query(query).mask(encode(example)).tolist() == [True]
+
+    # Columnar exports round trip, in chunks, from value columns or enum names.
+    library = PatchTable.from_patches([test_patch, example, p])
+    for filename in "test_columns.npz", "test_columns.csv", "test_columns.jsonl":
+        assert export_columns(library, filename, chunk_size=2) == 3
+        chunks = list(import_columns(filename, chunk_size=2))
+        assert [len(chunk) for chunk in chunks] == [2, 1]
+        assert b"".join(chunk.tobytes() for chunk in chunks) == library.tobytes()
+    with numpy.load("test_columns.npz") as npz:
+        assert npz["filter.frequency"].tolist() == [p.filter.frequency for p in (test_patch, example, p)]
+        assert npz["meta._name:text"][0] == "Initial Patch   "
+    with open("test_columns.jsonl") as f:
+        row = json.loads(f.readline())
+    assert row["filter.type:name"] == "BAND_PASS_12DB" and row["meta._name:text"] == "Initial Patch   "
+    with open("test_columns.jsonl", "w") as f:
+        f.write(json.dumps({k: v for k, v in row.items() if k != "filter.type"}) + "\n")
+    assert next(import_columns("test_columns.jsonl")).tobytes() == encode(test_patch)
+
+    # Morphs interpolate numeric fields, and switch enums and bitfield fields part way.
+    morphed = morph([example, replace(test_patch, header=Header())], 5, switch={"lfos": 0.75})
+    assert morph([clone(example), example], 3).tobytes() == encode(example) * 3
+    assert len(morphed) == 5 and not check_many(morphed)[1].any()
+    assert list(morphed["filter.frequency"]) == [38, 37, 36, 36, 35]
+    assert list(morphed["filter.type"]) == [FilterType.LOW_PASS_24DB] * 2 + [FilterType.BAND_PASS_12DB] * 3
+    assert [morphed.patch(i).lfos[0].flags.one_shot for i in range(5)] == [0, 0, 0, 1, 1]
+    assert set(morphed["meta._name"]) == {example.meta.name}
+
+    # Mutations and crossovers keep to the values each field allows.
+    population = PatchTable.from_patches([example] * 200)
+    mutated = mutate(population, {"mod_matrix": 1, "lfos": 1}, amount=127, rng=1)
+    assert not check_many(mutated)[1].any()
+    assert set(mutated["mod_matrix[0].source1"]) == set(ModMatrixSource)
+    assert {get_field(row, "lfos[1].flags.fade_mode") for row in mutated.data} == set(LfoFadeMode)
+    children = crossover(population, mutated, rng=2)
+    diff_paths, changed = diff_many(encode(example), children)
+    assert 0 < changed.sum() < diff_many(encode(example), mutated)[1].sum()
+    next_generation = evolve(mutated, numpy.arange(200), elite=3, rng=3)
+    assert len(next_generation) == 200 and next_generation.tobytes()[:3 * 350] == mutated.data[:196:-1].tobytes()
+
+    similar = SimilarityIndex.from_table(PatchTable.from_patches([example, test_patch]), keys=["example", "test"])
+    assert [key for key, _ in similar.query(test_patch, k=2)] == ["test", "example"]
+    similar.save("test_similar.npz")
+    assert SimilarityIndex.load("test_similar.npz").keys == ["example", "test"]
+    numpy.savez("test_similar.npz", features=similar.features, keys=numpy.array(similar.keys), command_type="Path")
+    try:
+        SimilarityIndex.load("test_similar.npz")
+        assert False
+    except ValueError as e:
+        assert "unknown command type 'Path'" in str(e)
+
 # import itertools
 # import re
 # with open("test.py") as f: